@@ -0,0 +1,507 @@
+import bisect
+
+import numpy as np
+
+from .search import TILE_BYTES, get_subseqs, nearest_pattern_search
+from .index import make_index
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def get_adaptive_thresholds(anomalous_clusters, cluster_sizes, cluster_radii, max_anomalous_cluster_size=None):
+    # An anomalous graph with a size larger than max_anomalous_cluster_size will be regarded as normal.
+    if max_anomalous_cluster_size is None:
+        if len(anomalous_clusters) == 0:
+            max_anomalous_cluster_size = np.min(np.array(cluster_sizes))
+        else:
+            max_anomalous_cluster_size = np.max(np.array(cluster_sizes)[anomalous_clusters])
+
+    if len(anomalous_clusters) == 0:
+        anomalous_max_dist = benign_max_dist = np.max(cluster_radii)
+    else:
+        cluster_radii_tmp = np.array(cluster_radii)
+        anomalous_max_dist = np.max(cluster_radii_tmp[anomalous_clusters])
+        cluster_radii_tmp[anomalous_clusters] = 0
+        benign_max_dist = np.max(cluster_radii_tmp)
+
+    return max_anomalous_cluster_size, anomalous_max_dist, benign_max_dist
+
+
+def _learn_loop(metrics, starts, centers, sizes, radii, anomalous, anomalous_origin, last_hits, created_steps,
+                cluster_num, cluster_limit, step, anomalous_max_dist, benign_max_dist, max_anomalous_cluster_size,
+                verdicts):
+    # Scalar loops for the compiled kernel. It returns before a subsequence that needs a new cluster
+    # once cluster_limit clusters exist, so that the caller can grow the arrays or evict a cluster.
+    m = centers.shape[1]
+    guess = 0
+    for t in range(len(starts)):
+        start = starts[t]
+        # Start from the nearest pattern of the previous subsequence and abandon a distance once it is worse
+        nearest_pattern, nearest_sq_dist = guess, 0.0
+        for j in range(m):
+            diff = centers[guess, j] - metrics[start + j]
+            nearest_sq_dist += diff * diff
+        for c in range(cluster_num):
+            if c == guess:
+                continue
+            sq_dist = 0.0
+            for j in range(m):
+                diff = centers[c, j] - metrics[start + j]
+                sq_dist += diff * diff
+                if sq_dist > nearest_sq_dist:
+                    break
+            if sq_dist < nearest_sq_dist or (sq_dist == nearest_sq_dist and c < nearest_pattern):
+                nearest_pattern, nearest_sq_dist = c, sq_dist
+        guess = nearest_pattern
+        nearest_dist = np.sqrt(nearest_sq_dist)
+
+        is_anomaly = anomalous[nearest_pattern]
+        d_prime = anomalous_max_dist if is_anomaly else benign_max_dist
+
+        # Create a new anomalous cluster
+        if d_prime < nearest_dist:
+            if cluster_num == cluster_limit:
+                return t, cluster_num, step, anomalous_max_dist, benign_max_dist
+
+            for j in range(m):
+                centers[cluster_num, j] = metrics[start + j]
+            sizes[cluster_num] = 1
+            radii[cluster_num] = 0.0
+            anomalous[cluster_num] = True
+            anomalous_origin[cluster_num] = False
+            last_hits[cluster_num] = created_steps[cluster_num] = step
+            cluster_num += 1
+
+        else:
+            # If combine subseq to the nearest graph, we have
+            cluster_size = sizes[nearest_pattern]
+            subseq_sq_dist, shift_sq_dist = 0.0, 0.0
+            for j in range(m):
+                updated = (centers[nearest_pattern, j] * cluster_size + metrics[start + j]) / (cluster_size + 1)
+                subseq_sq_dist += (updated - metrics[start + j]) ** 2
+                shift_sq_dist += (updated - centers[nearest_pattern, j]) ** 2
+                centers[nearest_pattern, j] = updated
+            subseq_dist = np.sqrt(subseq_sq_dist)
+            updated_graph_dist = np.sqrt(shift_sq_dist) + radii[nearest_pattern]
+            max_dist = subseq_dist if subseq_dist > updated_graph_dist else updated_graph_dist
+
+            radii[nearest_pattern] = max_dist
+            sizes[nearest_pattern] += 1
+            last_hits[nearest_pattern] = step
+
+            if is_anomaly:
+                if sizes[nearest_pattern] > max_anomalous_cluster_size and not anomalous_origin[nearest_pattern]:
+                    anomalous[nearest_pattern] = False
+                elif max_dist > anomalous_max_dist:
+                    anomalous_max_dist = max_dist
+
+            elif max_dist > benign_max_dist:
+                benign_max_dist = max_dist
+
+        verdicts[t] = is_anomaly
+        step += 1
+
+    return len(starts), cluster_num, step, anomalous_max_dist, benign_max_dist
+
+
+_learn_kernel = njit(cache=True, nogil=True)(_learn_loop) if njit is not None else None
+
+# The arrays holding the state of every cluster, in the order of the clusters
+CLUSTER_ARRAYS = ('cluster_centers', 'cluster_sizes', 'cluster_radii', 'anomalous', 'anomalous_origin', 'pinned',
+                  'last_hits', 'created_steps')
+
+# The relative error allowed for the squared distances of a block computed by a matrix product, far above
+# their rounding error: the clusters scored within it of the nearest one are measured exactly
+BLOCK_SCORE_TOLERANCE = 1e-9
+
+
+class PatternBank:
+    """The learned metric patterns as preallocated arrays that adaptive learning updates in place.
+
+    With max_cluster_num set, a new cluster beyond the cap evicts one of the clusters learned online, chosen
+    by the eviction policy: 'lru' (least recently matched), 'size' (smallest) or 'age' (oldest). With
+    merge_every set, clusters of the same kind whose centers lie within each other's radius are merged
+    after every merge_every learned subsequences. Clusters from the offline phase are never evicted nor
+    merged with each other.
+
+    With index set ('brute' or 'coarse', see adsketch.index), the nearest centers are found through an index
+    that is updated along with the bank, instead of scanning every center.
+
+    With block_size set, the NumPy and index paths learn in micro-batches: a block of subsequences is scored
+    against the bank in one vectorized pass, then learned in order, only the clusters updated or created
+    within the block being searched again. The outcomes are those of learning one subsequence at a time:
+    identical without an index, and up to the rounding of the index distances with one. Without block_size,
+    the compiled kernel learns one subsequence at a time at compiled speed when Numba is installed.
+    """
+
+    def __init__(self, cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters,
+                 max_anomalous_cluster_size=None, max_cluster_num=None, eviction='lru', merge_every=None,
+                 use_numba=True, index=None, index_params=None, block_size=None):
+        cluster_num = len(cluster_centers)
+        self.cluster_num = cluster_num
+        self.cluster_centers = np.array(cluster_centers, dtype=float).reshape(cluster_num, -1)
+        self.m = self.cluster_centers.shape[1]
+        self.cluster_sizes = np.array(cluster_sizes, dtype=np.int64)
+        self.cluster_radii = np.array(cluster_radii, dtype=float)
+        self.anomalous = np.zeros(cluster_num, dtype=bool)
+        self.anomalous[np.array(anomalous_clusters, dtype=np.int64)] = True
+        # Clusters identified in the offline phase are never demoted to benign
+        self.anomalous_origin = self.anomalous.copy()
+        self.pinned = np.ones(cluster_num, dtype=bool)
+        # The step at which each cluster was last matched and created, a step being one learned subsequence
+        self.last_hits = np.zeros(cluster_num, dtype=np.int64)
+        self.created_steps = np.zeros(cluster_num, dtype=np.int64)
+        self.step = 0
+
+        max_anomalous_cluster_size, anomalous_max_dist, benign_max_dist = get_adaptive_thresholds(
+            anomalous_clusters, cluster_sizes, cluster_radii, max_anomalous_cluster_size)
+        self.max_anomalous_cluster_size = int(max_anomalous_cluster_size)
+        self.anomalous_max_dist, self.benign_max_dist = float(anomalous_max_dist), float(benign_max_dist)
+
+        if max_cluster_num is not None and max_cluster_num <= cluster_num:
+            raise ValueError(f'max_cluster_num ({max_cluster_num}) must exceed the {cluster_num} offline clusters')
+        self.max_cluster_num = max_cluster_num
+        self.configure(max_cluster_num, eviction, merge_every)
+        self.block_size = block_size
+        # Counts the evictions, merges and growths, which invalidate the distances scored for a block
+        self.layout_version = 0
+        self.index_name, self.index_params = index, index_params
+        self.index = None if index is None else make_index(self.centers, index, **(index_params or {}))
+        # The compiled kernel scans every center itself
+        self.use_numba = use_numba and _learn_kernel is not None and self.index is None
+
+    @classmethod
+    def from_state(cls, header, arrays):
+        """Restore a bank from the header and arrays of get_state, e.g. loaded from a checkpoint."""
+        if header.get('kind') != 'pattern_bank':
+            raise ValueError('The state is not the state of a pattern bank')
+        bank = cls(arrays['cluster_centers'], arrays['cluster_sizes'], arrays['cluster_radii'],
+                   np.flatnonzero(arrays['anomalous']), header['max_anomalous_cluster_size'],
+                   eviction=header['eviction'], merge_every=header['merge_every'], use_numba=header['use_numba'],
+                   index=header['index'], index_params=header['index_params'], block_size=header['block_size'])
+        for name in CLUSTER_ARRAYS:
+            getattr(bank, name)[:] = arrays[name]
+        # The cap may already be reached, which the constructor refuses
+        bank.max_cluster_num = header['max_cluster_num']
+        bank.step = header['step']
+        bank.anomalous_max_dist, bank.benign_max_dist = header['anomalous_max_dist'], header['benign_max_dist']
+        return bank
+
+    def configure(self, max_cluster_num, eviction='lru', merge_every=None):
+        """Set the cap, eviction policy and merge period of the bank, e.g. of one restored from a checkpoint. A
+        cap below the current number of clusters evicts clusters learned online down to it."""
+        pinned_num = np.count_nonzero(self.pinned[:self.cluster_num])
+        if max_cluster_num is not None and max_cluster_num <= pinned_num:
+            raise ValueError(f'max_cluster_num ({max_cluster_num}) must exceed the {pinned_num} offline clusters')
+        if eviction not in ('lru', 'size', 'age'):
+            raise ValueError(f'Unknown eviction policy: {eviction}')
+        self.max_cluster_num, self.eviction, self.merge_every = max_cluster_num, eviction, merge_every
+        while max_cluster_num is not None and self.cluster_num > max_cluster_num:
+            self.evict_cluster()
+
+    def get_state(self):
+        """The settings and thresholds of the bank as a JSON-serializable header, and its cluster arrays."""
+        header = {'kind': 'pattern_bank', 'step': int(self.step), 'max_anomalous_cluster_size': self.max_anomalous_cluster_size,
+                  'anomalous_max_dist': self.anomalous_max_dist, 'benign_max_dist': self.benign_max_dist,
+                  'max_cluster_num': self.max_cluster_num, 'eviction': self.eviction,
+                  'merge_every': self.merge_every, 'block_size': self.block_size, 'use_numba': self.use_numba,
+                  'index': self.index_name, 'index_params': self.index_params}
+        arrays = {name: getattr(self, name)[:self.cluster_num] for name in CLUSTER_ARRAYS}
+        return header, arrays
+
+    @property
+    def anomalous_clusters(self):
+        return np.where(self.anomalous[:self.cluster_num])[0].tolist()
+
+    @property
+    def centers(self):
+        return self.cluster_centers[:self.cluster_num]
+
+    def nearest(self, subseqs):
+        if self.index is not None:
+            return self.index.search(subseqs)
+        return nearest_pattern_search(subseqs, self.centers)
+
+    def is_anomalous(self, subseqs):
+        nearest_patterns, _ = self.nearest(subseqs)
+        return self.anomalous[nearest_patterns]
+
+    def learn(self, metrics, starts):
+        """Score the subsequences starting at starts one by one, learning from each of them in turn."""
+        metrics = np.ascontiguousarray(metrics, dtype=float)
+        starts = np.asarray(starts, dtype=np.int64)
+        verdicts = np.zeros(len(starts), dtype=bool)
+        subseqs = get_subseqs(metrics, self.m)
+
+        done = 0
+        while done < len(starts):
+            end = len(starts)
+            if self.merge_every:
+                end = min(end, done + self.merge_every - self.step % self.merge_every)
+
+            if self.block_size and self.block_size > 1:
+                self._learn_blocks(subseqs, starts[done: end], verdicts[done: end])
+            elif self.use_numba:
+                self._learn_compiled(metrics, starts[done: end], verdicts[done: end])
+            else:
+                for t in range(done, end):
+                    verdicts[t] = self.learn_one(subseqs[starts[t]].copy())
+            done = end
+
+            if self.merge_every and self.step % self.merge_every == 0:
+                self.merge_clusters()
+
+        return verdicts
+
+    def _learn_compiled(self, metrics, starts, verdicts):
+        done = 0
+        while True:
+            processed, self.cluster_num, self.step, self.anomalous_max_dist, self.benign_max_dist = _learn_kernel(
+                metrics, starts[done:], self.cluster_centers, self.cluster_sizes, self.cluster_radii,
+                self.anomalous, self.anomalous_origin, self.last_hits, self.created_steps, self.cluster_num,
+                self._cluster_limit(), self.step, self.anomalous_max_dist, self.benign_max_dist,
+                self.max_anomalous_cluster_size, verdicts[done:])
+            done += processed
+            if done == len(starts):
+                break
+            # The kernel stopped at a subsequence that needs a new cluster
+            self._make_room()
+
+    def _learn_blocks(self, subseqs, starts, verdicts):
+        done, block_len = 0, self.block_size
+        while done < len(starts):
+            if self.index is None:
+                # A block scores into a block_len x cluster_num matrix
+                block_len = min(block_len, max(1, TILE_BYTES // (8 * self.cluster_num)))
+            block_subseqs = subseqs[starts[done: done + block_len]]
+
+            if self.index is None:
+                # Approximate squared distances of the whole block in one matrix product, and the slack within
+                # which a cluster may still be the nearest one
+                centers = self.centers
+                center_sq_norms = np.einsum('ij,ij->i', centers, centers)
+                subseq_sq_norms = np.einsum('ij,ij->i', block_subseqs, block_subseqs)
+                sq_dists = subseq_sq_norms[:, None] - 2 * block_subseqs @ centers.T + center_sq_norms
+                slacks = BLOCK_SCORE_TOLERANCE * (subseq_sq_norms + np.max(center_sq_norms))
+                learned = self._learn_scored(block_subseqs, (sq_dists, slacks), verdicts[done:])
+            else:
+                learned = self._learn_scored(block_subseqs, self.index.search(block_subseqs), verdicts[done:])
+            done += learned
+            # Evictions cut blocks short, so the blocks shrink while they keep happening and grow back after
+            block_len = min(self.block_size, 2 * learned)
+
+    def _learn_scored(self, subseqs, scores, verdicts):
+        # Learn the subsequences in order, given how they score against the bank before the first of them:
+        # approximate squared distances and slacks, or the nearest patterns and distances from the index.
+        # The scores still hold for the clusters left untouched since, so only the clusters updated or
+        # created within the block are measured again. It returns early when the bank layout changes,
+        # which invalidates the rest.
+        layout_version, scored_num = self.layout_version, self.cluster_num
+        updated = np.zeros(scored_num, dtype=bool)
+        # The updated clusters in increasing order, so that ties go to the lowest index as with argmin
+        updated_clusters = []
+        for t, subseq in enumerate(subseqs):
+            searched = False
+            if self.index is None:
+                # The candidates are measured exactly as learn_one measures them
+                sq_dists, slacks = scores
+                row = sq_dists[t]
+                candidates = np.flatnonzero(row <= np.min(row) + slacks[t])
+                if updated_clusters:
+                    candidates = np.union1d(candidates, updated_clusters)
+                dists = np.linalg.norm(self.cluster_centers[candidates] - subseq, axis=1)
+                closest = np.argmin(dists)
+                nearest_pattern, nearest_dist = candidates[closest], dists[closest]
+            elif updated[scores[0][t]]:
+                nearest_pattern, nearest_dist = self._nearest_one(subseq)
+                searched = True
+            else:
+                nearest_pattern, nearest_dist = scores[0][t], scores[1][t]
+                if updated_clusters:
+                    dists = np.linalg.norm(self.cluster_centers[updated_clusters] - subseq, axis=1)
+                    closest = np.argmin(dists)
+                    if dists[closest] < nearest_dist or (dists[closest] == nearest_dist and
+                                                         updated_clusters[closest] < nearest_pattern):
+                        nearest_pattern, nearest_dist = updated_clusters[closest], dists[closest]
+
+            if self.cluster_num > scored_num and not searched:
+                # The clusters created within the block come after the scored ones
+                created_dists = np.linalg.norm(self.cluster_centers[scored_num: self.cluster_num] - subseq, axis=1)
+                closest = np.argmin(created_dists)
+                if created_dists[closest] < nearest_dist:
+                    nearest_pattern, nearest_dist = scored_num + closest, created_dists[closest]
+
+            cluster_num = self.cluster_num
+            verdicts[t] = self._absorb(subseq, nearest_pattern, nearest_dist)
+            if self.layout_version != layout_version:
+                return t + 1
+            if self.cluster_num == cluster_num and nearest_pattern < scored_num and not updated[nearest_pattern]:
+                updated[nearest_pattern] = True
+                bisect.insort(updated_clusters, int(nearest_pattern))
+                if self.index is None:
+                    # Its scores are stale, it is a candidate of every later subsequence
+                    scores[0][t + 1:, nearest_pattern] = np.inf
+
+        return len(subseqs)
+
+    def _nearest_one(self, subseq):
+        if self.index is None:
+            dists = np.linalg.norm(self.centers - subseq, axis=1)
+            nearest_pattern = np.argmin(dists)
+            return nearest_pattern, dists[nearest_pattern]
+
+        nearest_patterns, nearest_dists = self.index.search(subseq[None])
+        return nearest_patterns[0], nearest_dists[0]
+
+    def learn_one(self, subseq):
+        nearest_pattern, nearest_dist = self._nearest_one(subseq)
+        return self._absorb(subseq, nearest_pattern, nearest_dist)
+
+    def _absorb(self, subseq, nearest_pattern, nearest_dist):
+        is_anomaly = bool(self.anomalous[nearest_pattern])
+        d_prime = self.anomalous_max_dist if is_anomaly else self.benign_max_dist
+
+        # Create a new anomalous cluster
+        if d_prime < nearest_dist:
+            if self.cluster_num == self._cluster_limit():
+                # Make room first and match the subsequence against the remaining clusters, like the kernel
+                self._make_room()
+                return self.learn_one(subseq)
+            self.add_cluster(subseq)
+
+        else:
+            # If combine subseq to the nearest graph, we have
+            cluster_center, cluster_size = self.cluster_centers[nearest_pattern], self.cluster_sizes[nearest_pattern]
+            updated_center = (cluster_center * cluster_size + subseq) / (cluster_size + 1)
+            # The distance between the updated center and subsequence
+            subseq_dist = np.linalg.norm(updated_center - subseq)
+            # The distance between the updated center and the farthest node in the worst case
+            updated_graph_dist = np.linalg.norm(updated_center - cluster_center) + self.cluster_radii[nearest_pattern]
+            max_dist = subseq_dist if subseq_dist > updated_graph_dist else updated_graph_dist
+
+            # Update the radius, cluster center, and cluster size
+            self.cluster_radii[nearest_pattern] = max_dist
+            self.cluster_centers[nearest_pattern] = updated_center
+            if self.index is not None:
+                self.index.update(nearest_pattern, updated_center)
+            self.cluster_sizes[nearest_pattern] += 1
+            self.last_hits[nearest_pattern] = self.step
+
+            if is_anomaly:
+                # If the size of a new anomalous cluster is too large,
+                # it is removed for suspiciously being a benign cluster
+                if self.cluster_sizes[nearest_pattern] > self.max_anomalous_cluster_size and \
+                        not self.anomalous_origin[nearest_pattern]:
+                    self.anomalous[nearest_pattern] = False
+                elif max_dist > self.anomalous_max_dist:
+                    self.anomalous_max_dist = float(max_dist)
+
+            elif max_dist > self.benign_max_dist:
+                self.benign_max_dist = float(max_dist)
+
+        self.step += 1
+        return is_anomaly
+
+    def add_cluster(self, subseq):
+        if self.cluster_num == self._cluster_limit():
+            self._make_room()
+
+        cluster_num = self.cluster_num
+        self.cluster_centers[cluster_num] = subseq
+        self.cluster_sizes[cluster_num] = 1
+        self.cluster_radii[cluster_num] = 0.0
+        self.anomalous[cluster_num] = True
+        self.anomalous_origin[cluster_num] = False
+        self.pinned[cluster_num] = False
+        self.last_hits[cluster_num] = self.created_steps[cluster_num] = self.step
+        self.cluster_num += 1
+        if self.index is not None:
+            self.index.add(subseq)
+
+    def _cluster_limit(self):
+        if self.max_cluster_num is None:
+            return len(self.cluster_centers)
+        return min(len(self.cluster_centers), self.max_cluster_num)
+
+    def _make_room(self):
+        if self.max_cluster_num is not None and self.cluster_num >= self.max_cluster_num:
+            self.evict_cluster()
+        else:
+            self._grow()
+
+    def _grow(self):
+        # Grow the preallocated arrays geometrically
+        capacity = max(2 * len(self.cluster_centers), 16)
+        if self.max_cluster_num is not None:
+            capacity = min(capacity, self.max_cluster_num)
+        self.cluster_centers = np.resize(self.cluster_centers, (capacity, self.m))
+        self.layout_version += 1
+        for name in CLUSTER_ARRAYS[1:]:
+            setattr(self, name, np.resize(getattr(self, name), capacity))
+        # The compiled kernel does not track pinning, clusters created online are never pinned
+        self.pinned[self.cluster_num:] = False
+
+    def evict_cluster(self):
+        cluster_num = self.cluster_num
+        candidates = np.where(~self.pinned[:cluster_num])[0]
+        if self.eviction == 'lru':
+            keys = self.last_hits[candidates]
+        elif self.eviction == 'size':
+            keys = self.cluster_sizes[candidates]
+        else:
+            keys = self.created_steps[candidates]
+        self.remove_clusters(candidates[[np.argmin(keys)]])
+
+    def remove_clusters(self, clusters):
+        # Compact the arrays, keeping the remaining clusters in order
+        keep = np.ones(self.cluster_num, dtype=bool)
+        keep[clusters] = False
+        kept_num = np.count_nonzero(keep)
+        for name in CLUSTER_ARRAYS:
+            array = getattr(self, name)
+            array[:kept_num] = array[:self.cluster_num][keep]
+        self.cluster_num = kept_num
+        self.layout_version += 1
+        if self.index is not None:
+            self.index.remove(clusters)
+
+    def merge_clusters(self):
+        """Merge clusters of the same kind whose centers lie within each other's radius."""
+        cluster_num = self.cluster_num
+        centers, radii, sizes = self.centers, self.cluster_radii[:cluster_num], self.cluster_sizes[:cluster_num]
+        sq_norms = np.einsum('ij,ij->i', centers, centers)
+        dists = np.sqrt(np.maximum(sq_norms[:, None] - 2 * centers @ centers.T + sq_norms, 0))
+        anomalous = self.anomalous[:cluster_num]
+        pinned = self.pinned[:cluster_num]
+        # Two offline clusters are kept apart, the offline patterns are only ever extended
+        close = (dists < np.minimum(radii[:, None], radii)) & (anomalous[:, None] == anomalous) & \
+            ~(pinned[:, None] & pinned)
+        pairs = np.argwhere(np.triu(close, 1))
+        # Merge the closest pairs first, each cluster at most once per round
+        pairs = pairs[np.argsort(dists[pairs[:, 0], pairs[:, 1]], kind='stable')]
+
+        merged = np.zeros(cluster_num, dtype=bool)
+        removed = []
+        for i, j in pairs:
+            if merged[i] or merged[j]:
+                continue
+            merged_center = (centers[i] * sizes[i] + centers[j] * sizes[j]) / (sizes[i] + sizes[j])
+            # The distance to the farthest node in the worst case, as when a subsequence joins a cluster
+            radii[i] = max(np.linalg.norm(merged_center - centers[i]) + radii[i],
+                           np.linalg.norm(merged_center - centers[j]) + radii[j])
+            centers[i] = merged_center
+            if self.index is not None:
+                self.index.update(i, merged_center)
+            sizes[i] += sizes[j]
+            self.anomalous_origin[i] |= self.anomalous_origin[j]
+            self.pinned[i] |= self.pinned[j]
+            self.last_hits[i] = max(self.last_hits[i], self.last_hits[j])
+            self.created_steps[i] = min(self.created_steps[i], self.created_steps[j])
+            merged[i] = merged[j] = True
+            removed.append(j)
+
+        if removed:
+            self.remove_clusters(np.array(removed))
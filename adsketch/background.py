@@ -0,0 +1,89 @@
+import multiprocessing
+
+import numpy as np
+
+from .search import get_subseqs, get_tile_size, nearest_pattern_search
+from .matrix_profile import EXCLUSION_ZONE_DENOM, MatrixProfileCache, get_mp_cache
+
+# Without a cached matrix profile, the interim threshold is estimated from the nearest non-trivial matches of
+# at most this many training windows, so that the interim model costs O(INTERIM_SAMPLE_NUM * n) and not O(n^2)
+INTERIM_SAMPLE_NUM = 2000
+
+
+class BackgroundTask:
+    """Runs func(*args, **kwargs) in a worker process, e.g. the offline training of a metric, and lets the
+    caller poll it without blocking."""
+
+    def __init__(self, func, *args, **kwargs):
+        self._pool = multiprocessing.Pool(1)
+        self._result = self._pool.apply_async(func, args, kwargs)
+        self._pool.close()
+
+    def ready(self):
+        return self._result.ready()
+
+    def get(self, timeout=None):
+        """Wait for the result, raising the exception of the worker if it failed."""
+        try:
+            return self._result.get(timeout)
+        finally:
+            if self._result.ready():
+                self._pool.join()
+
+    def cancel(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+class NearestWindowModel:
+    """An interim model for a metric whose patterns are not learned yet.
+
+    Every training window is a benign pattern, and a window is anomalous when it lies farther from all of them
+    than the noise_p percentile of the distances between each training window and its nearest non-trivial
+    match, i.e. the training matrix profile. The profile is read from the matrix-profile cache when self_join
+    has already computed it, and is otherwise estimated on a random sample of sample_num training windows.
+    """
+
+    def __init__(self, scaled_train_metrics, m, noise_p=100, sample_num=INTERIM_SAMPLE_NUM, mp_cache=None):
+        self.m = m
+        scaled_train_metrics = np.asarray(scaled_train_metrics, dtype=float)
+        self.train_subseqs = get_subseqs(scaled_train_metrics, m)
+        train_mp = self._get_cached_train_mp(scaled_train_metrics, mp_cache)
+        if train_mp is None:
+            train_mp = self._get_train_mp(sample_num)
+        train_mp = train_mp[np.isfinite(train_mp)]
+        # Without any non-trivial match, nothing can be told apart from the training data
+        self.threshold = np.percentile(train_mp, noise_p) if len(train_mp) else np.inf
+
+    def _get_cached_train_mp(self, scaled_train_metrics, mp_cache):
+        # Only a lookup, computing the exact profile is what the background worker is for
+        if mp_cache is None:
+            mp_cache = get_mp_cache()
+        if not mp_cache:
+            return None
+        # The profile of multi_window_joins only differs by rounding, which does not matter for a percentile
+        for kind in ('self', 'multi_self'):
+            cached = mp_cache.get(MatrixProfileCache.get_key(kind, self.m, scaled_train_metrics))
+            if cached is not None:
+                return np.asarray(cached[0])
+        return None
+
+    def _get_train_mp(self, sample_num):
+        subseqs = self.train_subseqs
+        rows = np.arange(len(subseqs))
+        if len(rows) > sample_num:
+            rows = np.sort(np.random.choice(rows, sample_num, replace=False))
+        sq_norms = np.einsum('ij,ij->i', subseqs, subseqs)
+        exclusion = int(np.ceil(self.m / EXCLUSION_ZONE_DENOM))
+        tile_size = get_tile_size(self.m, len(subseqs))
+        mp = np.empty(len(rows))
+        for start in range(0, len(rows), tile_size):
+            tile_rows = rows[start: start + tile_size]
+            sq_dists = sq_norms[tile_rows, None] - 2 * subseqs[tile_rows] @ subseqs.T + sq_norms
+            sq_dists[np.abs(tile_rows[:, None] - np.arange(len(subseqs))) <= exclusion] = np.inf
+            mp[start: start + len(tile_rows)] = np.sqrt(np.maximum(np.min(sq_dists, axis=1), 0))
+        return mp
+
+    def is_anomalous(self, subseqs):
+        _, nearest_dists = nearest_pattern_search(subseqs, self.train_subseqs)
+        return nearest_dists > self.threshold
@@ -0,0 +1,38 @@
+import os
+import json
+import tempfile
+
+import numpy as np
+
+# A checkpoint is an uncompressed .npz file: the arrays of the state and a JSON header under HEADER_KEY,
+# so that restoring it never unpickles anything
+CHECKPOINT_VERSION = 1
+HEADER_KEY = '__header__'
+
+
+def save_checkpoint(path, header, arrays):
+    """Write a header (a JSON-serializable dict) and a dict of arrays to path, atomically.
+
+    The checkpoint is written to a temporary file next to path and renamed over it, so that a reader or a
+    crash never sees half a checkpoint.
+    """
+    header_bytes = json.dumps(dict(header, version=CHECKPOINT_VERSION)).encode()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as writer:
+            np.savez(writer, **{HEADER_KEY: np.frombuffer(header_bytes, dtype=np.uint8)}, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """Return the header and the arrays of a checkpoint."""
+    with np.load(path, allow_pickle=False) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    header = json.loads(arrays.pop(HEADER_KEY).tobytes())
+    if header['version'] > CHECKPOINT_VERSION:
+        raise ValueError(f'{path} has checkpoint version {header["version"]}, newer than the supported '
+                         f'{CHECKPOINT_VERSION}')
+    return header, arrays
@@ -0,0 +1,121 @@
+import os
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .search import get_subseqs, nearest_pattern_search
+
+# Below this number of window-center distances the search is cheaper in the calling process
+PARALLEL_MIN_WORK = 50_000_000
+
+_default_executor = None
+
+
+def get_available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _search_into(metrics, centers, nearest_patterns, nearest_dists, m, stride, start, end):
+    subseqs = get_subseqs(metrics, m, stride)[start: end]
+    nearest_patterns[start: end], nearest_dists[start: end] = nearest_pattern_search(subseqs, centers)
+
+
+def _search_unit(task):
+    # Runs in a worker: read the inputs and write the results through shared memory, nothing is pickled back
+    specs, m, stride, start, end = task
+    shms, arrays = zip(*[_attach(*spec) for spec in specs])
+    try:
+        _search_into(*arrays, m, stride, start, end)
+    finally:
+        # The views must be released before the blocks can be closed
+        del arrays
+        for shm in shms:
+            shm.close()
+
+
+class PatternSearchExecutor:
+    """A long-lived process pool for nearest-pattern search over shared-memory inputs."""
+
+    def __init__(self, process_num=None):
+        self.process_num = process_num or get_available_cores()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.process_num)
+        return self._pool
+
+    def search(self, scaled_test_metrics, m, graph_centers, stride=1):
+        # float32 metrics are searched in float32, anything else in float64
+        float_dtype = np.result_type(scaled_test_metrics, np.float32)
+        scaled_test_metrics = np.ascontiguousarray(scaled_test_metrics, dtype=float_dtype)
+        graph_centers = np.ascontiguousarray(graph_centers, dtype=float_dtype)
+        subseq_num = len(range(0, len(scaled_test_metrics) - m + 1, stride))
+
+        shms, arrays, specs = [], [], []
+        try:
+            for shape, dtype, data in [(scaled_test_metrics.shape, float_dtype, scaled_test_metrics),
+                                       (graph_centers.shape, float_dtype, graph_centers),
+                                       ((subseq_num,), np.int64, None),
+                                       ((subseq_num,), float_dtype, None)]:
+                nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+                shms.append(shared_memory.SharedMemory(create=True, size=nbytes))
+                arrays.append(np.ndarray(shape, dtype=dtype, buffer=shms[-1].buf))
+                specs.append((shms[-1].name, shape, dtype))
+                if data is not None:
+                    arrays[-1][:] = data
+
+            # A few units per process to balance the load
+            unit_size = max(1, -(-subseq_num // (4 * self.process_num)))
+            tasks = [(specs, m, stride, start, min(start + unit_size, subseq_num))
+                     for start in range(0, subseq_num, unit_size)]
+            self._get_pool().map(_search_unit, tasks)
+
+            nearest_patterns, nearest_dists = arrays[2].copy(), arrays[3].copy()
+        finally:
+            arrays.clear()
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+        return nearest_patterns, nearest_dists
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def get_executor():
+    """Return the executor shared by adsketch, or None where child processes cannot be started."""
+    global _default_executor
+    if multiprocessing.current_process().daemon or get_available_cores() < 2:
+        return None
+
+    if _default_executor is None:
+        _default_executor = PatternSearchExecutor()
+        atexit.register(shutdown_executor)
+    return _default_executor
+
+
+def shutdown_executor():
+    global _default_executor
+    if _default_executor is not None:
+        _default_executor.shutdown()
+        _default_executor = None
@@ -0,0 +1,188 @@
+import numpy as np
+
+from .search import get_tile_size, nearest_pattern_search
+
+# The relative rounding error allowed for the ||a||^2 - 2a.b + ||b||^2 identity when pruning with lower bounds
+PRUNE_TOLERANCE = 1e-9
+
+
+class BruteForceIndex:
+    """Scan every center, the reference that the other indexes must agree with."""
+
+    def __init__(self, centers):
+        self.centers = np.array(centers, dtype=float)
+
+    def __len__(self):
+        return len(self.centers)
+
+    def search(self, subseqs):
+        return nearest_pattern_search(subseqs, self.centers)
+
+    def add(self, center):
+        self.centers = np.vstack([self.centers, center])
+
+    def update(self, cluster, center):
+        self.centers[cluster] = center
+
+    def remove(self, clusters):
+        self.centers = np.delete(self.centers, clusters, axis=0)
+
+
+class CoarseQuantizerIndex:
+    """A two-level index: the centers are grouped into lists around coarse centroids.
+
+    Each list keeps an upper bound of the distance between its centroid and its members, so by the triangle
+    inequality ||q - c|| >= ||q - g|| - r for every member c of a list with centroid g and bound r. In exact mode
+    (n_probe=None) a list is only scanned when this lower bound can beat the best distance found so far, which
+    gives the same nearest centers as brute force. With n_probe set, only the n_probe lists with the nearest
+    centroids are scanned, trading accuracy for throughput.
+
+    Centers can be added, moved and removed in place. A moved center only loosens the bound of its list, and the
+    lists are rebuilt once the number of centers doubles.
+    """
+
+    def __init__(self, centers, list_num=None, n_probe=None, kmeans_iter=10):
+        self.list_num, self.n_probe, self.kmeans_iter = list_num, n_probe, kmeans_iter
+        self.build(centers)
+
+    def __len__(self):
+        return len(self.centers)
+
+    def build(self, centers):
+        centers = np.array(centers, dtype=float)
+        self.centers = centers
+        self.center_norms = np.einsum('ij,ij->i', centers, centers)
+        list_num = self.list_num or max(1, int(round(np.sqrt(len(centers)))))
+        list_num = min(list_num, len(centers))
+
+        # A few Lloyd iterations from evenly spaced centers, deterministic for a given bank
+        centroids = centers[np.linspace(0, len(centers) - 1, list_num).astype(np.int64)].copy()
+        for _ in range(self.kmeans_iter):
+            list_ids, _ = nearest_pattern_search(centers, centroids)
+            counts = np.bincount(list_ids, minlength=list_num)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, list_ids, centers)
+            filled = counts > 0
+            # An empty list keeps its centroid
+            updated = centroids.copy()
+            updated[filled] = sums[filled] / counts[filled, None]
+            if np.array_equal(updated, centroids):
+                break
+            centroids = updated
+
+        self.centroids = centroids
+        self.centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.list_ids, dists = nearest_pattern_search(centers, centroids)
+        self.list_radii = np.zeros(list_num)
+        np.maximum.at(self.list_radii, self.list_ids, dists)
+        self._members = None
+        self.built_num = len(centers)
+
+    def members(self):
+        # The centers of every list in ascending order, cached until a center joins or leaves a list
+        if self._members is None:
+            order = np.argsort(self.list_ids, kind='stable')
+            bounds = np.cumsum(np.bincount(self.list_ids, minlength=len(self.centroids)))[:-1]
+            self._members = np.split(order, bounds)
+        return self._members
+
+    def _assign(self, center):
+        list_id, dist = nearest_pattern_search(center[None], self.centroids)
+        self.list_radii[list_id[0]] = max(self.list_radii[list_id[0]], dist[0])
+        return list_id[0]
+
+    def add(self, center):
+        center = np.asarray(center, dtype=float)
+        self.centers = np.vstack([self.centers, center])
+        self.center_norms = np.append(self.center_norms, center @ center)
+        self.list_ids = np.append(self.list_ids, self._assign(center))
+        self._members = None
+        if len(self.centers) >= 2 * self.built_num:
+            self.build(self.centers)
+
+    def update(self, cluster, center):
+        center = np.asarray(center, dtype=float)
+        self.centers[cluster] = center
+        self.center_norms[cluster] = center @ center
+        # The center stays in its list, whose bound grows to cover it
+        list_id = self.list_ids[cluster]
+        self.list_radii[list_id] = max(self.list_radii[list_id], np.linalg.norm(center - self.centroids[list_id]))
+
+    def remove(self, clusters):
+        # The bounds of the lists stay valid, if looser, when members leave
+        self.centers = np.delete(self.centers, clusters, axis=0)
+        self.center_norms = np.delete(self.center_norms, clusters)
+        self.list_ids = np.delete(self.list_ids, clusters)
+        self._members = None
+
+    def search(self, subseqs):
+        """Return the index of the nearest center and the Euclidean distance to it as arrays."""
+        subseq_num, m = subseqs.shape
+        nearest_patterns = np.empty(subseq_num, dtype=np.int64)
+        nearest_dists = np.empty(subseq_num, dtype=float)
+        tile_size = get_tile_size(m, len(self.centroids))
+        for start in range(0, subseq_num, tile_size):
+            end = min(start + tile_size, subseq_num)
+            tile = np.ascontiguousarray(subseqs[start: end], dtype=float)
+            nearest_patterns[start: end] = self._search_tile(tile)
+            nearest_dists[start: end] = np.linalg.norm(tile - self.centers[nearest_patterns[start: end]], axis=1)
+        return nearest_patterns, nearest_dists
+
+    def _scan(self, tile, queries, candidates, best_scores, best_patterns):
+        # Compare the queries against the candidate centers, keeping the best ||b||^2 - 2a.b so far
+        if len(candidates) == 0:
+            return
+        scores = self.center_norms[candidates] - 2 * tile[queries] @ self.centers[candidates].T
+        nearest = np.argmin(scores, axis=1)
+        nearest_scores = scores[np.arange(len(queries)), nearest]
+        nearest_patterns = candidates[nearest]
+        # Ties go to the lower index, as with np.argmin over all the centers
+        better = (nearest_scores < best_scores[queries]) | \
+            ((nearest_scores == best_scores[queries]) & (nearest_patterns < best_patterns[queries]))
+        best_scores[queries[better]] = nearest_scores[better]
+        best_patterns[queries[better]] = nearest_patterns[better]
+
+    def _search_tile(self, tile):
+        members = self.members()
+        list_num = len(members)
+        tile_norms = np.einsum('ij,ij->i', tile, tile)
+        # Rounding errors of the identity scale with the norms, the bounds are loosened accordingly
+        slack = PRUNE_TOLERANCE * (tile_norms[:, None] + self.centroid_norms)
+        centroid_sq_dists = tile_norms[:, None] - 2 * tile @ self.centroids.T + self.centroid_norms
+        lower_bounds = np.sqrt(np.maximum(centroid_sq_dists - slack, 0)) - self.list_radii
+
+        best_scores = np.full(len(tile), np.inf)
+        best_patterns = np.zeros(len(tile), dtype=np.int64)
+
+        # The nearest list of every query first, so that the bound is tight for the other lists
+        first_lists = np.argmin(centroid_sq_dists, axis=1)
+        for list_id in np.unique(first_lists):
+            self._scan(tile, np.where(first_lists == list_id)[0], members[list_id], best_scores, best_patterns)
+
+        best_dists = np.sqrt(np.maximum(best_scores + tile_norms, 0) + PRUNE_TOLERANCE * tile_norms)
+        remaining = lower_bounds <= best_dists[:, None]
+        remaining[np.arange(len(tile)), first_lists] = False
+        if self.n_probe is not None and self.n_probe < list_num:
+            probed = np.argpartition(centroid_sq_dists, self.n_probe - 1, axis=1)[:, :self.n_probe]
+            probed_lists = np.zeros_like(remaining)
+            np.put_along_axis(probed_lists, probed, True, axis=1)
+            remaining &= probed_lists
+
+        if len(tile) < list_num:
+            # Few queries, gather all the lists left for each of them into one product
+            for query in np.where(remaining.any(axis=1))[0]:
+                candidates = np.concatenate([members[list_id] for list_id in np.where(remaining[query])[0]])
+                self._scan(tile, np.array([query]), candidates, best_scores, best_patterns)
+        else:
+            for list_id in np.where(remaining.any(axis=0))[0]:
+                self._scan(tile, np.where(remaining[:, list_id])[0], members[list_id], best_scores, best_patterns)
+
+        return best_patterns
+
+
+def make_index(centers, index='brute', **index_params):
+    if index == 'brute':
+        return BruteForceIndex(centers)
+    if index == 'coarse':
+        return CoarseQuantizerIndex(centers, **index_params)
+    raise ValueError(f'Unknown index: {index}')
@@ -0,0 +1,303 @@
+import os
+import time
+import atexit
+import hashlib
+import multiprocessing
+import tempfile
+
+import stumpy
+import numpy as np
+
+from .checkpoint import load_checkpoint, save_checkpoint
+
+try:
+    from dask.distributed import Client, LocalCluster
+except ImportError:
+    Client = LocalCluster = None
+
+# The default on-disk cache of matrix profiles, in the per-user cache directory. Set ADSKETCH_MP_CACHE_DIR to
+# another directory, or to an empty string to disable it
+MP_CACHE_DIR = os.environ.get('ADSKETCH_MP_CACHE_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'adsketch', 'mp'))
+MP_CACHE_BYTES = int(os.environ.get('ADSKETCH_MP_CACHE_BYTES', 1 << 30))
+# Temporary files older than this many seconds were left by a writer that died before renaming them
+MP_CACHE_TMP_AGE = 3600
+# The Dask scheduler computing the matrix profiles: unset to compute them in the calling process, 'local' for
+# a local cluster of one worker process per core, or the address of a scheduler, e.g. tcp://10.0.0.1:8786
+MP_SCHEDULER = os.environ.get('ADSKETCH_DASK_SCHEDULER', '')
+# Windows of a self-join within ceil(m / EXCLUSION_ZONE_DENOM) points of each other are trivial matches
+EXCLUSION_ZONE_DENOM = stumpy.config.STUMPY_EXCL_ZONE_DENOM
+
+_default_cache = None
+_default_client = None
+_default_cluster = None
+
+
+class MatrixProfileCache:
+    """Content-addressed matrix profiles and their indices as memory-mapped .npy files.
+
+    An entry is keyed by a hash of the join kind, m and the series, so it is shared by every p, noise_p and
+    damping. Once the directory exceeds max_bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir=MP_CACHE_DIR, max_bytes=MP_CACHE_BYTES):
+        self.cache_dir, self.max_bytes = cache_dir, max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(kind, m, *series):
+        digest = hashlib.sha1(f'{kind}:{m}:{stumpy.__version__}'.encode())
+        for metrics in series:
+            metrics = np.ascontiguousarray(metrics, dtype=float)
+            digest.update(str(metrics.shape).encode())
+            digest.update(metrics)
+        return digest.hexdigest()
+
+    def _paths(self, key):
+        return [os.path.join(self.cache_dir, f'{key}_{name}.npy') for name in ('mp', 'idx')]
+
+    def get(self, key):
+        try:
+            mp, mp_idx = [np.load(path, mmap_mode='r') for path in self._paths(key)]
+        except (FileNotFoundError, ValueError):
+            # Missing, or evicted or half-written by another process
+            return None
+        for path in self._paths(key):
+            try:
+                os.utime(path)
+            except OSError:
+                # Evicted since, or a read-only cache: the entry is still mapped and only ages sooner
+                pass
+        return mp, mp_idx
+
+    def put(self, key, mp, mp_idx):
+        for path, array in zip(self._paths(key), (mp, mp_idx)):
+            # Write then rename so that readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as writer:
+                np.save(writer, array)
+            os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries, stale_tmp_time = [], time.time() - MP_CACHE_TMP_AGE
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(('.npy', '.tmp')):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            if name.endswith('.npy'):
+                entries.append((stat.st_mtime, stat.st_size, name))
+            elif stat.st_mtime < stale_tmp_time:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                # Already evicted by another process, or still mapped on platforms that forbid removing it
+                pass
+            total_bytes -= size
+
+
+def get_mp_cache():
+    """Return the default cache, or None when it is disabled."""
+    global _default_cache
+    if not MP_CACHE_DIR:
+        return None
+    if _default_cache is None:
+        _default_cache = MatrixProfileCache()
+    return _default_cache
+
+
+def get_dask_client():
+    """Return the client of the default Dask scheduler, or None when it is not set.
+
+    A local cluster cannot start worker processes from a daemonic process, e.g. a worker of the runner's pool or
+    of a BackgroundTask, so there the matrix profiles are computed in the calling process.
+    """
+    global _default_client, _default_cluster
+    if not MP_SCHEDULER or (MP_SCHEDULER == 'local' and multiprocessing.current_process().daemon):
+        return None
+    if _default_client is None:
+        if Client is None:
+            raise ImportError('ADSKETCH_DASK_SCHEDULER requires dask.distributed, pip install "dask[distributed]"')
+        if MP_SCHEDULER == 'local':
+            _default_cluster = LocalCluster()
+        _default_client = Client(_default_cluster or MP_SCHEDULER)
+        atexit.register(shutdown_dask_client)
+    return _default_client
+
+
+def shutdown_dask_client():
+    global _default_client, _default_cluster
+    if _default_client is not None:
+        _default_client.close()
+        _default_client = None
+    # A client does not close the cluster it was given
+    if _default_cluster is not None:
+        _default_cluster.close()
+        _default_cluster = None
+
+
+def _stump(T_A, m, T_B=None, client=None):
+    # A self-join of T_A, or an AB-join with T_B. stumpy.stumped splits the diagonals of stumpy.stump among
+    # the Dask workers and computes each of them the same way.
+    # stumpy computes in float64 and only accepts float64 series, e.g. not the float32 ones of scale_two_metrics
+    T_A = np.asarray(T_A, dtype=float)
+    T_B = None if T_B is None else np.asarray(T_B, dtype=float)
+    client = client or get_dask_client()
+    if client is None:
+        return stumpy.stump(T_A, m, T_B, ignore_trivial=T_B is None, normalize=False)
+    return stumpy.stumped(client, T_A, m, T_B, ignore_trivial=T_B is None, normalize=False)
+
+
+def _cached_join(kind, m, series, compute, mp_cache):
+    if mp_cache is None:
+        mp_cache = get_mp_cache()
+    if not mp_cache:
+        return compute()
+
+    key = mp_cache.get_key(kind, m, *series)
+    cached = mp_cache.get(key)
+    if cached is not None:
+        return cached
+    mp, mp_idx = compute()
+    mp_cache.put(key, mp, mp_idx)
+    return mp, mp_idx
+
+
+def self_join(scaled_train_metrics, m, mp_cache=None, client=None):
+    """The matrix profile of the training metrics and the index of every nearest neighbour.
+
+    mp_cache is a MatrixProfileCache, None for the default one or False to skip caching. client is a Dask
+    client to compute the join on, by default the one of ADSKETCH_DASK_SCHEDULER if set.
+    """
+    def compute():
+        train_mp = _stump(scaled_train_metrics, m, client=client)
+        return train_mp[:, 0].astype(float), train_mp[:, 1].astype(np.int64)
+
+    return _cached_join('self', m, [scaled_train_metrics], compute, mp_cache)
+
+
+def ab_join_into(scaled_test_metrics, scaled_train_metrics, m, mp, mp_idx, start=0, chunk_size=None, client=None):
+    """Join the test subsequences from start on with the training metrics, chunk_size subsequences at a time,
+    writing their distances and indices into mp and mp_idx.
+
+    Peak memory is set by the chunk size. The distances agree with a single join up to rounding, so the index
+    of a subsequence with two equally near training subsequences may differ.
+    """
+    subseq_num = len(scaled_test_metrics) - m + 1
+    chunk_size = chunk_size or max(subseq_num - start, 1)
+    for chunk_start in range(start, subseq_num, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, subseq_num)
+        test_mp = _stump(scaled_test_metrics[chunk_start: chunk_end + m - 1], m, scaled_train_metrics, client)
+        mp[chunk_start: chunk_end] = test_mp[:, 0]
+        mp_idx[chunk_start: chunk_end] = test_mp[:, 1]
+
+
+def ab_join(scaled_test_metrics, scaled_train_metrics, m, mp_cache=None, chunk_size=None, out=None, client=None):
+    """The distance of every test subsequence to its nearest training subsequence, and its index.
+
+    With chunk_size set, the test metrics are joined chunk_size subsequences at a time (see ab_join_into). out
+    is an optional (mp, mp_idx) pair of float and int64 arrays to fill, e.g. from np.lib.format.open_memmap.
+    """
+    subseq_num = len(scaled_test_metrics) - m + 1
+
+    def compute():
+        mp, mp_idx = out if out is not None else (np.empty(subseq_num), np.empty(subseq_num, dtype=np.int64))
+        ab_join_into(scaled_test_metrics, scaled_train_metrics, m, mp, mp_idx, chunk_size=chunk_size, client=client)
+        return mp, mp_idx
+
+    mp, mp_idx = _cached_join('ab', m, [scaled_test_metrics, scaled_train_metrics], compute, mp_cache)
+    if out is not None and mp is not out[0]:
+        # Read from the cache
+        out[0][:], out[1][:] = mp, mp_idx
+        mp, mp_idx = out
+    return mp, mp_idx
+
+
+def incremental_ab_join(test_mp_path, scaled_test_metrics, scaled_train_metrics, m, chunk_size=None, client=None):
+    """The AB-join of the test metrics, persisted at test_mp_path and extended by the subsequences appended since.
+
+    Only the new subsequences are joined with the training metrics, as long as the saved join was computed
+    with the same m and training metrics and on a prefix of the test metrics. Otherwise it is recomputed.
+    """
+    subseq_num = len(scaled_test_metrics) - m + 1
+    train_key = MatrixProfileCache.get_key('ab_train', m, scaled_train_metrics)
+    mp, mp_idx = np.empty(subseq_num), np.empty(subseq_num, dtype=np.int64)
+
+    start = 0
+    if os.path.exists(test_mp_path):
+        header, arrays = load_checkpoint(test_mp_path)
+        saved_num = header['subseq_num']
+        if header['m'] == m and header['train_key'] == train_key and saved_num <= subseq_num and \
+                header['test_key'] == MatrixProfileCache.get_key('ab_test', m,
+                                                                 scaled_test_metrics[:saved_num + m - 1]):
+            mp[:saved_num], mp_idx[:saved_num] = arrays['mp'], arrays['mp_idx']
+            start = saved_num
+
+    ab_join_into(scaled_test_metrics, scaled_train_metrics, m, mp, mp_idx, start, chunk_size, client)
+    header = {'m': m, 'subseq_num': subseq_num, 'train_key': train_key,
+              'test_key': MatrixProfileCache.get_key('ab_test', m, scaled_test_metrics)}
+    save_checkpoint(test_mp_path, header, {'mp': mp, 'mp_idx': mp_idx})
+    return mp, mp_idx
+
+
+def progressive_join(T_A, m, T_B=None, percentage=0.01, pre_scrump=True, s=None):
+    """Yield approximate matrix profiles (mp, mp_idx, progress) of a self-join, or an AB-join with T_B, as they
+    are refined by stumpy.scrump, percentage of the distances at a time in a random order of the diagonals.
+
+    progress is the share of the chunks of diagonals computed so far, in scrump's own chunking, and the last
+    profile is the exact one with progress 1. With pre_scrump, the first profile is already close (PreSCRIMP),
+    which samples every s-th subsequence (by default ceil(m / 4)): a larger s is faster and coarser. The
+    diagonals are shuffled with np.random.
+    """
+    T_A = np.asarray(T_A, dtype=float)
+    T_B = None if T_B is None else np.asarray(T_B, dtype=float)
+    approx = stumpy.scrump(T_A, m, T_B, ignore_trivial=T_B is None, percentage=percentage, pre_scrump=pre_scrump,
+                           s=s, normalize=False)
+    # scrump splits the diagonals into chunks of about percentage of the distances, but not always ceil(1 / p)
+    step_num = getattr(approx, '_n_chunks', None) or int(np.ceil(1 / percentage))
+    for step in range(step_num + 1):
+        if step > 0:
+            approx.update()
+        mp = approx.P_
+        # Without PreSCRIMP, the first steps may leave subsequences without any neighbour. The exact profile is
+        # always yielded, even if some subsequence has no neighbour at all, e.g. in a very short series.
+        if np.isfinite(mp).all() or step == step_num:
+            yield mp.astype(float), approx.I_.astype(np.int64), step / step_num
+
+
+def progressive_joins(scaled_train_metrics, scaled_test_metrics, m, percentage=0.01, s=None):
+    """Refine the self-join of the training metrics and the AB-join of the test metrics together, yielding
+    (train_mp, train_mp_idx, test_mp, test_mp_idx, progress) after each step until both are exact.
+
+    progress is the share of all the distances computed so far (see progressive_join).
+    """
+    train_num = len(scaled_train_metrics) - m + 1
+    test_num = len(scaled_test_metrics) - m + 1
+    # A self-join computes about half of its distance matrix
+    train_weight, test_weight = train_num / 2, test_num
+
+    joins = [progressive_join(scaled_train_metrics, m, percentage=percentage, s=s),
+             progressive_join(scaled_test_metrics, m, scaled_train_metrics, percentage, s=s)]
+    latest = [next(join, None) for join in joins]
+    if any(profile is None for profile in latest):
+        raise ValueError(f'No matrix profile could be computed for m={m}, '
+                         f'on {len(scaled_train_metrics)} training and {len(scaled_test_metrics)} test points')
+    while True:
+        (train_mp, train_mp_idx, train_progress), (test_mp, test_mp_idx, test_progress) = latest
+        progress = (train_weight * train_progress + test_weight * test_progress) / (train_weight + test_weight)
+        yield train_mp, train_mp_idx, test_mp, test_mp_idx, progress
+        if train_progress == test_progress == 1:
+            return
+        latest = [next(join, last) for join, last in zip(joins, latest)]
@@ -1,61 +1,125 @@
 import os
-import copy
+import time
 import pickle
-import stumpy
 import numpy as np
 from tqdm import tqdm
-import networkx as nx
 import matplotlib.pyplot as plt
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from sklearn.cluster import AffinityPropagation
 from sklearn.metrics import precision_recall_fscore_support
 
 from .utils import *
+from .adaptive import PatternBank
+from .background import BackgroundTask, NearestWindowModel
+from .checkpoint import load_checkpoint, save_checkpoint
+from .matrix_profile import ab_join, incremental_ab_join, progressive_joins, self_join
+from .multi_window import multi_window_joins
+from .pattern_store import (PATTERN_FILE_EXT, find_pattern_file, is_pattern_file, load_header, load_patterns,
+                            save_patterns)
+from .scaler import StreamingScaler
 
 plt.rcParams["figure.figsize"] = [26, 4]
 
-
-def get_train_graph(mp, mp_idx, p):
-    G = nx.Graph()
-    for i in range(len(mp)):
-        if mp[i] <= p:
-            G.add_edge(i, mp_idx[i])
-        else:
-            G.add_nodes_from([i, mp_idx[i]])
-    return G
-
-
-# Combine Ina and Inn to get graph G
-def combine_graphs(G, test_mp, test_mp_idx, p):
-    train_node_num = G.number_of_nodes()
-
-    for i in range(len(test_mp)):
-        if test_mp[i] <= p:
-            # i + train_node_num to avoid index collision
-            G.add_edge(test_mp_idx[i], i + train_node_num)
-        else:
-            G.add_node(i + train_node_num)
-
-    return G
-
-
-def get_cluster_centers(m, train_node_num, graphs, train_metrics, test_metrics):
-    cluster_centers = []
-    cluster_radii = []
-
-    for graph in graphs:
-        seqs = []
-        for node in graph:
-            if node < train_node_num:
-                seqs.append(train_metrics[node: node + m])
-            else:
-                idx = node - train_node_num
-                seqs.append(test_metrics[idx: idx + m])
-
-        # Get the graph center for each cluster
-        cluster_centers.append(np.mean(seqs, axis=0))
-        # Get the radius for each cluster
-        dists = np.linalg.norm(seqs - cluster_centers[-1], axis=1)
-        cluster_radii.append(np.max(dists))
+# Affinity Propagation keeps about four dense n x n float64 matrices (similarity, availability, responsibility, tmp)
+AP_BYTES_PER_PAIR = 32
+AP_MEMORY_BUDGET = 2 << 30
+# The number of subsequences gathered at a time when computing cluster centers
+NODE_CHUNK_SIZE = 1 << 16
+# The number of subsequences learned between two progress updates in adaptive online mode
+LEARN_BLOCK_SIZE = 10000
+# The share of the distances computed by each refinement step of approximate matrix profiles
+MP_REFINE_PERCENTAGE = 0.01
+
+
+def get_train_edges(mp, mp_idx, p):
+    nodes = np.where(mp <= p)[0]
+    return nodes, mp_idx[nodes].astype(np.int64)
+
+
+# Combine Ina and Inn to get the edges of graph G
+def get_test_edges(test_mp, test_mp_idx, p, train_node_num):
+    nodes = np.where(test_mp <= p)[0]
+    # nodes + train_node_num to avoid index collision
+    return test_mp_idx[nodes].astype(np.int64), nodes + train_node_num
+
+
+def get_node_order(mp_idx, test_node_num):
+    # The order in which the nodes join G: each training node followed by its nearest neighbour, then the test nodes
+    train_node_num = len(mp_idx)
+    nodes, first_idx = np.unique(np.column_stack([np.arange(train_node_num), mp_idx]).ravel(), return_index=True)
+    return np.concatenate([nodes[np.argsort(first_idx)],
+                           np.arange(train_node_num, train_node_num + test_node_num)])
+
+
+def get_connected_subgraphs(edges, node_order, removed_nodes):
+    """Label the connected subgraphs of G from its edge arrays, with -1 for the removed nodes.
+
+    Subgraphs are numbered by the position of their first node in node_order.
+    """
+    node_num = len(node_order)
+    kept = np.ones(node_num, dtype=bool)
+    kept[removed_nodes] = False
+
+    src = np.concatenate([edge[0] for edge in edges])
+    dst = np.concatenate([edge[1] for edge in edges])
+    kept_edges = kept[src] & kept[dst]
+    adjacency = coo_matrix((np.ones(np.count_nonzero(kept_edges), dtype=np.int8),
+                            (src[kept_edges], dst[kept_edges])), shape=(node_num, node_num))
+    _, labels = connected_components(adjacency, directed=False)
+
+    ordered_labels = labels[node_order[kept[node_order]]]
+    _, first_idx = np.unique(ordered_labels, return_index=True)
+    relabel = np.full(labels.max() + 1, -1, dtype=np.int64)
+    relabel[ordered_labels[np.sort(first_idx)]] = np.arange(len(first_idx))
+
+    labels = relabel[labels]
+    labels[~kept] = -1
+    return labels
+
+
+def get_node_subseqs(m, nodes, train_metrics, test_metrics):
+    train_subseqs, test_subseqs = get_subseqs(train_metrics, m), get_subseqs(test_metrics, m)
+    train_node_num = len(train_subseqs)
+    for start in range(0, len(nodes), NODE_CHUNK_SIZE):
+        chunk = nodes[start: start + NODE_CHUNK_SIZE]
+        subseqs = np.empty((len(chunk), m), dtype=train_subseqs.dtype)
+        is_train = chunk < train_node_num
+        subseqs[is_train] = train_subseqs[chunk[is_train]]
+        subseqs[~is_train] = test_subseqs[chunk[~is_train] - train_node_num]
+        yield start, subseqs
+
+
+def get_cluster_centers(m, labels, train_metrics, test_metrics, cluster_num=None):
+    """Compute the center and radius of every cluster from the node -> cluster label array (-1 for no cluster).
+
+    Node i < len(train) - m + 1 is a training subsequence, the others are test subsequences. The subsequences
+    are gathered chunk by chunk, so the memory stays O(cluster_num * m) on top of one chunk. The sums are
+    accumulated in float64 and the centers and radii have the dtype of the metrics.
+
+    The nodes of a cluster are summed in ascending order, where the networkx version summed them in set order,
+    so a center can differ from it in the last bit. Affinity propagation can split near-ties differently on
+    such centers: on memory_usage_13 (m=5, p=99), 6 anomalous subsequences in 6 clusters instead of 7 in 7.
+    """
+    if cluster_num is None:
+        cluster_num = labels.max() + 1
+    nodes = np.where(labels >= 0)[0]
+    node_labels = labels[nodes]
+
+    cluster_sums = np.zeros((cluster_num, m))
+    for start, subseqs in get_node_subseqs(m, nodes, train_metrics, test_metrics):
+        chunk_labels = node_labels[start: start + len(subseqs)]
+        for j in range(m):
+            cluster_sums[:, j] += np.bincount(chunk_labels, weights=subseqs[:, j], minlength=cluster_num)
+    # Get the graph center for each cluster
+    cluster_centers = cluster_sums / np.bincount(node_labels, minlength=cluster_num)[:, None]
+    cluster_centers = cluster_centers.astype(train_metrics.dtype, copy=False)
+
+    # Get the radius for each cluster
+    cluster_radii = np.zeros(cluster_num, dtype=cluster_centers.dtype)
+    for start, subseqs in get_node_subseqs(m, nodes, train_metrics, test_metrics):
+        chunk_labels = node_labels[start: start + len(subseqs)]
+        np.maximum.at(cluster_radii, chunk_labels, np.linalg.norm(subseqs - cluster_centers[chunk_labels], axis=1))
 
     return cluster_centers, cluster_radii
 
@@ -65,6 +129,43 @@ def ap_clustering(cluster_centers, damping):
     return clustering.labels_
 
 
+def group_near_duplicates(cluster_centers, max_group_num, resolution=1e-3):
+    # Merge identical centers first, then snap them to a grid that is coarsened until few enough groups remain
+    _, groups = np.unique(cluster_centers, axis=0, return_inverse=True)
+    while groups.max() + 1 > max_group_num:
+        _, groups = np.unique(np.floor(cluster_centers / resolution).astype(np.int64), axis=0, return_inverse=True)
+        resolution *= 2
+    groups = groups.reshape(-1)
+
+    group_num = groups.max() + 1
+    group_sizes = np.bincount(groups, minlength=group_num)
+    group_centers = np.column_stack([np.bincount(groups, weights=column, minlength=group_num)
+                                     for column in np.asarray(cluster_centers).T]) / group_sizes[:, None]
+    return group_centers, groups
+
+
+def cluster_subgraphs(cluster_centers, damping, clustering='auto', memory_budget=AP_MEMORY_BUDGET):
+    """Group the subgraph centers with one of the clustering engines.
+
+    'ap' runs Affinity Propagation on all the centers, whose dense similarity matrices take O(n^2) memory.
+    'grid' runs it on one representative per group of near-duplicate centers, with as many groups as fit
+    in memory_budget, and labels every center with the cluster of its group. 'auto' picks 'ap' if it fits.
+    """
+    cluster_centers = np.asarray(cluster_centers)
+    max_group_num = max(int(np.sqrt(memory_budget / AP_BYTES_PER_PAIR)), 1)
+    if clustering == 'auto':
+        clustering = 'ap' if len(cluster_centers) <= max_group_num else 'grid'
+
+    if clustering == 'ap':
+        return ap_clustering(cluster_centers, damping)
+    elif clustering == 'grid':
+        group_centers, groups = group_near_duplicates(cluster_centers, max_group_num)
+        logging.info(f'{len(cluster_centers)} subgraphs pre-grouped into {len(group_centers)} groups for clustering')
+        return ap_clustering(group_centers, damping)[groups]
+    else:
+        raise ValueError(f'Unknown clustering engine: {clustering}')
+
+
 def draw_anomalous_subseqs(m, anomalous_subseqs, scaled_test_metrics, test_labels, fig_dir):
     plt.plot(scaled_test_metrics)
     test_labels = np.where(test_labels == 1)[0]
@@ -81,6 +182,11 @@ def draw_anomalous_subseqs(m, anomalous_subseqs, scaled_test_metrics, test_label
 
 
 def evaluate(m, anomalous_subseqs, test_metric_labels):
+    if len(anomalous_subseqs) == 0:
+        if sum(test_metric_labels) == 0:
+            return [1.] * 3  # The algorithm indeed recognizes such a situation
+        return [0.] * 3
+
     y_pred_tmp = []
     for pattern in anomalous_subseqs:
         y_pred_tmp.extend(list(np.arange(pattern, pattern+m)))
@@ -97,23 +203,8 @@ def evaluate(m, anomalous_subseqs, test_metric_labels):
 def evaluate_predictions(m, anomalous_subseqs, scaled_test_metrics, test_metric_labels, fig_dir):
     if len(anomalous_subseqs) == 0:
         logging.info('No anomalous patterns detected!')
-        if sum(test_metric_labels) == 0:
-            res = [1.] * 3  # The algorithm indeed recognizes such a situation
-        else:
-            res = [0.] * 3
-    else:
-        y_pred_tmp = []
-        for pattern in anomalous_subseqs:
-            y_pred_tmp.extend(list(np.arange(pattern, pattern+m)))
-
-        y_pred_tmp = sorted(list(set(y_pred_tmp)))
-        y_pred = np.zeros(len(test_metric_labels))
-        y_pred[y_pred_tmp] = 1
-        y_true = test_metric_labels
-
-        precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, average='binary')
-        res = [precision, recall, f1]
-    
+    res = evaluate(m, anomalous_subseqs, test_metric_labels)
+
     precision, recall, f1 = res
     logging.info('precision: {:.3f}, recall: {:.3f}, f1: {:.3f}'.format(precision, recall, f1))
     # Plot anomaly detection results
@@ -123,71 +214,142 @@ def evaluate_predictions(m, anomalous_subseqs, scaled_test_metrics, test_metric_
 
 
 # ADSketch Algorithm 1
-def anomaly_pattern_discovery(scaled_train_metrics, scaled_test_metrics, m, p=99, noise_p=100, damping=0.9):
-    train_mp = stumpy.stump(scaled_train_metrics, m, normalize=False)
+def anomaly_pattern_discovery(scaled_train_metrics, scaled_test_metrics, m, p=99, noise_p=100, damping=0.9,
+                              clustering='auto', memory_budget=AP_MEMORY_BUDGET, mp_cache=None, chunk_size=None,
+                              test_mp_path=None, mp_client=None, time_budget=None, mp_percentage=None):
+    # The matrix profiles only depend on the data and m, they are cached across runs (see matrix_profile.py).
+    # chunk_size bounds the memory of the AB-join of long test metrics, and with test_mp_path the AB-join is
+    # persisted there and only extended by the test metrics appended since the last run. mp_client is a Dask
+    # client computing the joins, by default the one of ADSKETCH_DASK_SCHEDULER or none.
+    # With time_budget (seconds) or mp_percentage (the share of the distances) set, the patterns are discovered
+    # on approximate matrix profiles refined until the budget is spent (see progressive_pattern_discovery).
+    if time_budget is not None or mp_percentage is not None:
+        train_mp, train_mp_idx, test_mp, test_mp_idx = approximate_joins(
+            scaled_train_metrics, scaled_test_metrics, m, time_budget, mp_percentage)
+        return discover_patterns(scaled_train_metrics, scaled_test_metrics, m, train_mp, train_mp_idx, test_mp,
+                                 test_mp_idx, p, noise_p, damping, clustering, memory_budget)
+
+    train_mp, train_mp_idx = self_join(scaled_train_metrics, m, mp_cache, mp_client)
+    if test_mp_path is not None:
+        test_mp, test_mp_idx = incremental_ab_join(test_mp_path, scaled_test_metrics, scaled_train_metrics, m,
+                                                   chunk_size, mp_client)
+    else:
+        test_mp, test_mp_idx = ab_join(scaled_test_metrics, scaled_train_metrics, m, mp_cache, chunk_size,
+                                       client=mp_client)
+
+    return discover_patterns(scaled_train_metrics, scaled_test_metrics, m, train_mp, train_mp_idx, test_mp,
+                             test_mp_idx, p, noise_p, damping, clustering, memory_budget)
+
+
+def approximate_joins(scaled_train_metrics, scaled_test_metrics, m, time_budget=None, mp_percentage=None):
+    # Refine both matrix profiles until time_budget seconds have passed or mp_percentage of the distances are
+    # computed, whichever comes first, after at least the first (PreSCRIMP) step
+    start_time = time.time()
+    for train_mp, train_mp_idx, test_mp, test_mp_idx, progress in progressive_joins(
+            scaled_train_metrics, scaled_test_metrics, m, MP_REFINE_PERCENTAGE):
+        if (time_budget is not None and time.time() - start_time >= time_budget) or \
+                (mp_percentage is not None and progress >= mp_percentage):
+            break
+    logging.info(f'Approximate matrix profiles: {progress:.1%} of the distances computed in '
+                 f'{time.time() - start_time:.2f}s')
+    return train_mp, train_mp_idx, test_mp, test_mp_idx
+
+
+def progressive_pattern_discovery(scaled_train_metrics, scaled_test_metrics, m, p=99, noise_p=100, damping=0.9,
+                                  clustering='auto', memory_budget=AP_MEMORY_BUDGET, percentage=0.1, s=None):
+    """Yield (progress, patterns), the patterns of anomaly_pattern_discovery on approximate matrix profiles
+    after each refinement of percentage of the distances, until the profiles are exact and progress is 1.
+
+    The first patterns come after PreSCRIMP with sampling interval s (see progressive_join). Each refinement only
+    runs when the next patterns are asked for, so the caller can stop at any time or keep refining later.
+    """
+    for train_mp, train_mp_idx, test_mp, test_mp_idx, progress in progressive_joins(
+            scaled_train_metrics, scaled_test_metrics, m, percentage, s):
+        yield progress, discover_patterns(scaled_train_metrics, scaled_test_metrics, m, train_mp, train_mp_idx,
+                                          test_mp, test_mp_idx, p, noise_p, damping, clustering, memory_budget)
+
+
+def multi_window_pattern_discovery(scaled_train_metrics, scaled_test_metrics, ms, p=99, noise_p=100, damping=0.9,
+                                   clustering='auto', memory_budget=AP_MEMORY_BUDGET, mp_cache=None):
+    """The patterns of anomaly_pattern_discovery for every window length in ms, as {m: patterns}, with the
+    matrix profiles of all of them computed in one pass (see multi_window_joins)."""
+    joins = multi_window_joins(scaled_train_metrics, scaled_test_metrics, ms, mp_cache)
+    return {m: discover_patterns(scaled_train_metrics, scaled_test_metrics, m, *joins[m], p, noise_p, damping,
+                                 clustering, memory_budget) for m in joins}
+
+
+def discover_patterns(scaled_train_metrics, scaled_test_metrics, m, train_mp, train_mp_idx, test_mp, test_mp_idx,
+                      p=99, noise_p=100, damping=0.9, clustering='auto', memory_budget=AP_MEMORY_BUDGET):
+    """The stages of anomaly_pattern_discovery after the matrix profiles, which depend on p, noise_p and damping."""
     # The threshold over which the subsequences will be considered as anomalies in the training data.
     # The default setting is that the training data are anomaly-free, i.e., noise_p=100.
     # A smaller noise_p means the training data are suspected to contain more anomalies
-    train_mp_p = np.percentile(train_mp[:, 0], noise_p)
-    train_anomalies_idxes = np.where(train_mp[:, 0] > train_mp_p)[0]
+    train_mp_p = np.percentile(train_mp, noise_p)
+    train_anomalies_idxes = np.where(train_mp > train_mp_p)[0]
 
-    G = get_train_graph(train_mp[:, 0], train_mp[:, 1], train_mp_p)
-    train_node_num = G.number_of_nodes()
+    train_edges = get_train_edges(train_mp, train_mp_idx, train_mp_p)
+    train_node_num = len(train_mp)
 
-    test_mp = stumpy.stump(scaled_test_metrics, m, scaled_train_metrics, ignore_trivial=False, normalize=False)
-    G = combine_graphs(G, test_mp[:, 0], test_mp[:, 1], np.percentile(test_mp[:, 0], p))
-    G.remove_nodes_from(train_anomalies_idxes)  # Remove the suspicious anomalies in the training data
+    test_edges = get_test_edges(test_mp, test_mp_idx, np.percentile(test_mp, p), train_node_num)
 
-    # Get connected subgraphs
-    subgraphs = list(nx.connected_components(G))
-    subgraphs = [list(subgraph) for subgraph in subgraphs]
+    # Get connected subgraphs, without the suspicious anomalies in the training data
+    node_order = get_node_order(train_mp_idx, len(test_mp))
+    subgraph_labels = get_connected_subgraphs([train_edges, test_edges], node_order, train_anomalies_idxes)
+    subgraph_num = subgraph_labels.max() + 1
 
-    isolated_nodes = [subgraph[0] for subgraph in subgraphs if len(subgraph) == 1]
-    isolated_nodes = np.array(isolated_nodes) - train_node_num
-    logging.info(f'The number of anomalous seqs: {len(isolated_nodes)}')
+    isolated_subgraphs = np.bincount(subgraph_labels[subgraph_labels >= 0], minlength=subgraph_num) == 1
+    logging.info(f'The number of anomalous seqs: {np.count_nonzero(isolated_subgraphs)}')
 
     # Group graph centers using Affinity Propagation
-    subcluster_centers, _ = get_cluster_centers(m, train_node_num, subgraphs, scaled_train_metrics, scaled_test_metrics)
-    labels = ap_clustering(subcluster_centers, damping)
-
-    label_dict = {}
-    for i in range(len(labels)):
-        label = labels[i]
-        if label not in label_dict:
-            label_dict[label] = []
-        label_dict[label].extend(subgraphs[i])
-    clusters = [label_dict[label] for label in label_dict]
-
-    anomalous_subseqs = []
-    anomalous_clusters = []
-    for i in range(len(clusters)):
-        nodes = np.array(clusters[i]) - train_node_num
-        if all([node in isolated_nodes for node in nodes]):
-            anomalous_subseqs.extend(nodes)
-            # anomalous_clusters.extend(label_dict[label])
-            anomalous_clusters.append(i)
+    subcluster_centers, _ = get_cluster_centers(m, subgraph_labels, scaled_train_metrics, scaled_test_metrics,
+                                                subgraph_num)
+    labels = cluster_subgraphs(subcluster_centers, damping, clustering, memory_budget)
+
+    # Number the clusters in the order they first appear
+    _, first_idx = np.unique(labels, return_index=True)
+    relabel = np.empty(labels.max() + 1, dtype=np.int64)
+    relabel[labels[np.sort(first_idx)]] = np.arange(len(first_idx))
+    subgraph_clusters = relabel[labels]
+    cluster_num = len(first_idx)
+    node_clusters = np.where(subgraph_labels >= 0, subgraph_clusters[subgraph_labels], -1)
+
+    # A cluster is anomalous if it only consists of isolated subgraphs
+    anomalous = np.bincount(subgraph_clusters, weights=~isolated_subgraphs, minlength=cluster_num) == 0
+    anomalous_clusters = np.where(anomalous)[0].tolist()
+    # The isolated test nodes of the anomalous clusters, ordered by cluster and then by subgraph
+    anomalous_nodes = np.where((node_clusters >= 0) & anomalous[node_clusters])[0]
+    anomalous_nodes = anomalous_nodes[np.lexsort((subgraph_labels[anomalous_nodes], node_clusters[anomalous_nodes]))]
+    anomalous_subseqs = (anomalous_nodes - train_node_num).tolist()
 
     logging.info(f'The number of anomalous seqs after ap clustering: {len(anomalous_subseqs)}')
     logging.info(f'The number of anomalous clusters: {len(anomalous_clusters)}')
 
-    cluster_sizes = [len(cluster) for cluster in clusters]
-    cluster_centers, cluster_radii = get_cluster_centers(m, train_node_num, clusters, scaled_train_metrics, scaled_test_metrics)
+    cluster_sizes = np.bincount(node_clusters[node_clusters >= 0], minlength=cluster_num).tolist()
+    cluster_centers, cluster_radii = get_cluster_centers(m, node_clusters, scaled_train_metrics, scaled_test_metrics,
+                                                         cluster_num)
+    cluster_centers, cluster_radii = list(cluster_centers), cluster_radii.tolist()
 
     return anomalous_subseqs, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii
 
 
 def offline_anomaly_detection(m, p,
                               train_metric_values, test_metric_values, test_metric_labels,
-                              offline_pattern_dir, fig_dir):
-    scaled_train_metrics, scaled_test_metrics = scale_two_metrics(train_metric_values, test_metric_values)
+                              offline_pattern_dir, fig_dir, dtype=None, **discovery_params):
+    # With dtype=np.float32, the metrics are scaled, clustered and saved in float32 (the matrix profiles are
+    # computed in float64 by stumpy)
+    scaler = StreamingScaler.from_metrics(train_metric_values)
+    scaled_train_metrics, scaled_test_metrics = scaler.transform(np.asarray(train_metric_values, dtype=dtype)), \
+        scaler.transform(np.asarray(test_metric_values, dtype=dtype))
 
     # anomalous_clusters: the id of the clusters that are identified as anomalous
     anomalous_subseqs, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii = anomaly_pattern_discovery(
-    scaled_train_metrics, scaled_test_metrics, m, p)
+    scaled_train_metrics, scaled_test_metrics, m, p, **discovery_params)
 
-    with open(offline_pattern_dir, 'wb') as pickle_writer:
-        pickle.dump([anomalous_subseqs, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii],
-                    pickle_writer)
+    # The training range lets the online phase rebuild the scaler without the training data
+    header = dict({'m': m, 'p': p}, **scaler.to_header())
+    header.update({key: discovery_params[key] for key in ('noise_p', 'damping') if key in discovery_params})
+    save_patterns(offline_pattern_dir, header, anomalous_subseqs, anomalous_clusters, cluster_sizes,
+                  cluster_centers, cluster_radii)
     logging.info('Metric patterns dumped.')
 
     res = evaluate_predictions(m, anomalous_subseqs, scaled_test_metrics, test_metric_labels, fig_dir)
@@ -195,126 +357,146 @@ def offline_anomaly_detection(m, p,
     return res
 
 
+def load_metric_patterns(offline_pattern_dir, allow_pickle=True):
+    """Load the learned patterns, memory-mapped from a pattern file or unpickled from a legacy .pkl file.
+
+    Set allow_pickle=False to refuse legacy files from untrusted sources.
+    """
+    if is_pattern_file(offline_pattern_dir):
+        _, arrays = load_patterns(offline_pattern_dir)
+        return (arrays['anomalous_subseqs'], arrays['anomalous_clusters'], arrays['cluster_sizes'],
+                arrays['cluster_centers'], arrays['cluster_radii'])
+
+    if not allow_pickle:
+        raise ValueError(f'{offline_pattern_dir} is not a pattern file and allow_pickle is False')
+    with open(offline_pattern_dir, 'rb') as pickle_reader:
+        anomalous_subseqs, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii = pickle.load(
+            pickle_reader)
+
+    return anomalous_subseqs, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii
+
+
+def log_pattern_bank(bank):
+    anomalous_sizes = bank.cluster_sizes[:bank.cluster_num][bank.anomalous[:bank.cluster_num]]
+    logging.info('anomalous_max_dist: {:.3f}, benign_max_dist: {:.3f}'.format(bank.anomalous_max_dist,
+                                                                              bank.benign_max_dist))
+    logging.info(f'anomalous cluster num: {len(anomalous_sizes)}, '
+                 f'benign cluster num: {bank.cluster_num - len(anomalous_sizes)}')
+    logging.info(f'max_anomalous_cluster_size: {bank.max_anomalous_cluster_size}, '
+                 f'max_anomalous_cluster_size (current): {np.max(anomalous_sizes, initial=0)}, '
+                 f'max_benign_cluster_size: {np.max(bank.cluster_sizes[:bank.cluster_num])}')
+
+
 def online_anomaly_detection(adaptive_learning, m, p, max_anomalous_cluster_size,
                              train_metric_values, test_metric_values, test_metric_labels, online_test_metric_values, online_test_metric_labels,
-                             offline_pattern_dir, fig_dir, stride=1):
-    _, online_scaled_test_metrics = scale_two_metrics(train_metric_values, online_test_metric_values)
-
-    # Check if the metric patterns learned from the offline phase exist
-    if not os.path.exists(offline_pattern_dir):
+                             offline_pattern_dir, fig_dir, stride=1, index=None, index_params=None,
+                             pruning=False, block_size=None, checkpoint_path=None, background_training=False,
+                             dtype=None, max_cluster_num=None, eviction='lru', merge_every=None):
+    """max_cluster_num, eviction and merge_every bound the pattern bank of adaptive learning (see PatternBank),
+    also when it is restored from checkpoint_path. With block_size set, adaptive learning scores block_size
+    windows at a time in micro-batches instead of learning them in the compiled kernel (see PatternBank).
+
+    With background_training, missing patterns are learned in a worker process while a NearestWindowModel of
+    the training windows gives the online windows provisional verdicts. The whole stream is already there, so
+    the call still waits for the learned patterns and every final verdict comes from them. To serve a live
+    stream from the interim model until then, use OnlineDetector.train_in_background.
+
+    With dtype=np.float32, missing patterns are learned in float32 (see offline_anomaly_detection) and the
+    online windows are scaled and searched in float32. Adaptive learning keeps its bank in float64.
+    """
+    # The subsequences to predict normality
+    starts = np.arange(0, len(online_test_metric_values) - m + 1, stride)
+
+    # Check if the metric patterns learned from the offline phase exist, possibly as a legacy pickle
+    if find_pattern_file(offline_pattern_dir) is None and background_training:
+        logging.info('Metric patterns not found, conduct offline anomaly detection in the background')
+        trainer = BackgroundTask(offline_anomaly_detection, m, p, train_metric_values, test_metric_values,
+                                 test_metric_labels, offline_pattern_dir, fig_dir + '_offline.png', dtype)
+        scaler = StreamingScaler.from_metrics(train_metric_values)
+        interim_subseqs = get_subseqs(scaler.transform(online_test_metric_values), m)
+        interim_model = NearestWindowModel(scaler.transform(train_metric_values), m)
+        done, interim_anomaly_num = 0, 0
+        while done < len(starts) and not trainer.ready():
+            block = starts[done: done + LEARN_BLOCK_SIZE]
+            interim_anomaly_num += np.count_nonzero(interim_model.is_anomalous(interim_subseqs[block]))
+            done += len(block)
+        logging.info(f'{interim_anomaly_num} of the first {done} subsequences are provisionally anomalous by the '
+                     f'interim model, waiting for the metric patterns')
+        # Every subsequence has a provisional verdict unless the patterns are ready already
+        trainer.get()
+
+    elif find_pattern_file(offline_pattern_dir) is None:
         logging.info('Metric patterns not found, conduct offline anomaly detection first')
         offline_anomaly_detection(m, p, train_metric_values, test_metric_values, test_metric_labels, 
-                                  offline_pattern_dir, fig_dir+'_offline.png')
+                                  offline_pattern_dir, fig_dir+'_offline.png', dtype)
 
     logging.info('Loading metric patterns...')
-    with open(offline_pattern_dir, 'rb') as pickle_reader:
-        anomalous_subseqs, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii = pickle.load(
-            pickle_reader)
+    pattern_file = find_pattern_file(offline_pattern_dir)
+    anomalous_subseqs, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii = load_metric_patterns(
+        pattern_file)
+    # The scaler is fitted once, from the range saved with the patterns unless they are a legacy pickle
+    if is_pattern_file(pattern_file):
+        scaler = StreamingScaler.from_header(load_header(pattern_file))
+    else:
+        scaler = StreamingScaler.from_metrics(train_metric_values)
+    online_scaled_test_metrics = scaler.transform(np.asarray(online_test_metric_values, dtype=dtype))
 
-    if os.path.exists(offline_pattern_dir):
-        _, scaled_test_metrics = scale_two_metrics(train_metric_values, test_metric_values)
-        evaluate_predictions(m, anomalous_subseqs, scaled_test_metrics,
-                             test_metric_labels, fig_dir + '_offline.png')
-
-    # The number of metric subsequences to predict normality
-    online_subseq_num = len(online_scaled_test_metrics) - m + 1
-    anomalous_clusters_origin = copy.deepcopy(anomalous_clusters)
-    # An anomalous graph with a size larger than max_anomalous_cluster_size will be regarded as normal.
-    if max_anomalous_cluster_size is None:
-        if len(anomalous_clusters) == 0:
-            max_anomalous_cluster_size = np.min(np.array(cluster_sizes))
-        else:
-            max_anomalous_cluster_size = np.max(np.array(cluster_sizes)[anomalous_clusters])
+    # The patterns exist by now, as a pattern file or a legacy pickle
+    scaled_test_metrics = scaler.transform(np.asarray(test_metric_values, dtype=dtype))
+    evaluate_predictions(m, anomalous_subseqs, scaled_test_metrics,
+                         test_metric_labels, fig_dir + '_offline.png')
 
     if adaptive_learning:
         logging.info('Online mode with adaptive pattern learning...')
-
-        if len(anomalous_clusters) == 0:
-            anomalous_max_dist = benign_max_dist = np.max(cluster_radii)
+        # The prediction results in online mode
+        verdicts = np.zeros(len(starts), dtype=bool)
+        learned_num = 0
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            # Resume the patterns learned by an earlier run instead of starting over from the offline ones. The
+            # windows before its stream offset are already absorbed, they keep their saved verdicts.
+            checkpoint_header, checkpoint_arrays = load_checkpoint(checkpoint_path)
+            bank = PatternBank.from_state(checkpoint_header, checkpoint_arrays)
+            bank.configure(max_cluster_num, eviction, merge_every)
+            learned_num = int(np.searchsorted(starts, checkpoint_header.get('next_start', 0)))
+            verdicts[:learned_num] = np.isin(starts[:learned_num], checkpoint_arrays.get('anomalous_starts', []))
+            logging.info(f'Restored the pattern bank from {checkpoint_path}, {learned_num} windows already learned')
         else:
-            cluster_radii_tmp = np.array(cluster_radii)
-            anomalous_max_dist = np.max(cluster_radii_tmp[anomalous_clusters])
-            cluster_radii_tmp[anomalous_clusters] = 0
-            benign_max_dist = np.max(cluster_radii_tmp)
+            bank = PatternBank(cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters,
+                               max_anomalous_cluster_size, max_cluster_num, eviction, merge_every,
+                               index=index, index_params=index_params, block_size=block_size)
 
         logging.info('Interesting parameters (before updating)')
-        logging.info('anomalous_max_dist: {:.3f}, benign_max_dist: {:.3f}'.format(anomalous_max_dist, benign_max_dist))
-        logging.info(f'anomalous cluster num: {len(anomalous_clusters)}, '
-                     f'benign cluster num: {len(cluster_radii) - len(anomalous_clusters)}')
-        logging.info(f'max_anomalous_cluster_size: {max_anomalous_cluster_size}, '
-                     f'max_benign_cluster_size: {np.max(cluster_sizes)}')
-
-        # The prediction results in online mode
-        online_anomalous_subseqs = []
-        progress_bar = tqdm(range(0, online_subseq_num, stride))
-        for i in progress_bar:
-            subseq = online_scaled_test_metrics[np.arange(i, i+m)]
-            dists = np.linalg.norm(cluster_centers - subseq, axis=1)
-            nearest_pattern = np.argmin(dists)
-            nearest_dist = dists[nearest_pattern]
-
-            progress_bar.set_description('#anomalous graph {} ({:.3f}/{:.3f})'.format(len(anomalous_clusters),
-                                                                                      anomalous_max_dist,
-                                                                                      nearest_dist))
-
-            # If combine subseq to the nearest graph, we have
-            cluster_center, cluster_size = cluster_centers[nearest_pattern], cluster_sizes[nearest_pattern]
-            updated_center = (cluster_center * cluster_size + subseq) / (cluster_size + 1)
-            # The distance between the updated center and subsequence
-            subseq_dist = np.linalg.norm(updated_center - subseq)
-            # The distance between the updated center and the farthest node in the worst case
-            updated_graph_dist = np.linalg.norm(updated_center - cluster_center) + cluster_radii[nearest_pattern]
-            max_dist = subseq_dist if subseq_dist > updated_graph_dist else updated_graph_dist
-
-            d_prime = benign_max_dist
-            if nearest_pattern in anomalous_clusters:
-                online_anomalous_subseqs.append(i)  # Predicted as an anomaly
-                d_prime = anomalous_max_dist
-
-            # Create a new anomalous cluster
-            if d_prime < nearest_dist:
-                # len(cluster_radii) is the id of the new anomalous cluster
-                anomalous_clusters.append(len(cluster_radii))
-                cluster_centers.append(subseq)
-                cluster_sizes.append(1)
-                cluster_radii.append(0.0)
-
-            else:
-                # Update the radius, cluster center, and cluster size
-                cluster_radii[nearest_pattern] = max_dist
-                cluster_centers[nearest_pattern] = updated_center
-                cluster_sizes[nearest_pattern] += 1
-
-                if nearest_pattern in anomalous_clusters:
-                    # If the size of a new anomalous cluster is too large,
-                    # it is removed for suspiciously being a benign cluster
-                    if cluster_sizes[nearest_pattern] > max_anomalous_cluster_size and \
-                            nearest_pattern not in anomalous_clusters_origin:
-                            anomalous_clusters.remove(int(nearest_pattern))
-                    else:
-                        # Update anomalous_max_dist
-                        if max_dist > anomalous_max_dist:
-                            anomalous_max_dist = max_dist
-
-                else:
-                    # Update benign_max_dist
-                    if max_dist > benign_max_dist:
-                        benign_max_dist = max_dist
+        log_pattern_bank(bank)
+
+        progress_bar = tqdm(total=len(starts), initial=learned_num)
+        for block in range(learned_num, len(starts), LEARN_BLOCK_SIZE):
+            verdicts[block: block + LEARN_BLOCK_SIZE] = bank.learn(online_scaled_test_metrics,
+                                                                   starts[block: block + LEARN_BLOCK_SIZE])
+            progress_bar.set_description('#anomalous graph {} ({:.3f})'.format(len(bank.anomalous_clusters),
+                                                                               bank.anomalous_max_dist))
+            progress_bar.update(len(starts[block: block + LEARN_BLOCK_SIZE]))
+            if checkpoint_path is not None:
+                # The stream offset of the next window to learn and the verdicts so far go with the bank
+                learned_end = min(block + LEARN_BLOCK_SIZE, len(starts))
+                checkpoint_header, checkpoint_arrays = bank.get_state()
+                checkpoint_header['next_start'] = int(starts[learned_end - 1]) + 1
+                checkpoint_arrays['anomalous_starts'] = starts[:learned_end][verdicts[:learned_end]]
+                save_checkpoint(checkpoint_path, checkpoint_header, checkpoint_arrays)
+        progress_bar.close()
+        online_anomalous_subseqs = starts[verdicts]
 
         logging.info('Interesting parameters (after updating)')
-        logging.info('anomalous_max_dist: {:.3f}, benign_max_dist: {:.3f}'.format(anomalous_max_dist, benign_max_dist))
-        logging.info(f'anomalous cluster num: {len(anomalous_clusters)}, '
-                     f'benign cluster num: {len(cluster_radii) - len(anomalous_clusters)}')
-        logging.info(f'max_anomalous_cluster_size: {np.max(np.array(cluster_sizes)[anomalous_clusters])}, '
-                     f'max_benign_cluster_size: {np.max(cluster_sizes)}')
+        log_pattern_bank(bank)
 
     else:
         logging.info('Online mode without adaptive pattern learning...')
-        logging.info(f'The number of subsequences to predict normality: {online_subseq_num}')
-        nearest_patterns, nearest_dists = find_nearest_pattern(online_scaled_test_metrics, m, cluster_centers, stride)
-
-        online_anomalous_subseqs = [i for i in range(0, online_subseq_num, stride) if
-                                    nearest_patterns[int(i/stride)] in anomalous_clusters]
+        logging.info(f'The number of subsequences to predict normality: {len(starts)}')
+        online_anomalous_subseqs = starts[:0]
+        if len(starts):
+            nearest_patterns, nearest_dists = find_nearest_pattern(online_scaled_test_metrics[starts[0]:], m,
+                                                                   cluster_centers, stride, index=index,
+                                                                   index_params=index_params, pruning=pruning)
+            online_anomalous_subseqs = starts[np.isin(nearest_patterns, anomalous_clusters)]
 
     online_fig = f'{fig_dir}_adaptive_online.png' if adaptive_learning else f'{fig_dir}_online.png'
     evaluate_predictions(m, online_anomalous_subseqs, online_scaled_test_metrics, 
@@ -0,0 +1,94 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+from .matrix_profile import EXCLUSION_ZONE_DENOM, ab_join, get_mp_cache, self_join
+
+
+def _multi_window_loop(T_A, T_B, ms, exclusions, diags, is_self_join, sq_mp, mp_idx):
+    # Along the diagonal k, T_A[i:] is aligned with T_B[i + k:]. The squared differences of the aligned points
+    # are computed once per diagonal, and the squared distance of every window length is a running sum of them.
+    n_A, n_B = len(T_A), len(T_B)
+    sq_diffs = np.empty(min(n_A, n_B))
+    for k in diags:
+        i_start = max(0, -k)
+        length = min(n_A - i_start, n_B - i_start - k)
+        for t in range(length):
+            diff = T_A[i_start + t] - T_B[i_start + t + k]
+            sq_diffs[t] = diff * diff
+
+        for w in range(len(ms)):
+            m = ms[w]
+            if is_self_join and k <= exclusions[w]:
+                continue
+            sq_dist = 0.0
+            for t in range(m - 1):
+                sq_dist += sq_diffs[t]
+            for t in range(length - m + 1):
+                if t > 0:
+                    sq_dist -= sq_diffs[t - 1]
+                sq_dist += sq_diffs[t + m - 1]
+                i, j = i_start + t, i_start + t + k
+                if sq_dist < sq_mp[w, i]:
+                    sq_mp[w, i], mp_idx[w, i] = sq_dist, j
+                if is_self_join and sq_dist < sq_mp[w, j]:
+                    sq_mp[w, j], mp_idx[w, j] = sq_dist, i
+
+
+_multi_window_kernel = njit(cache=True, nogil=True)(_multi_window_loop) if njit is not None else None
+
+
+def _multi_window_join(T_A, ms, T_B=None):
+    is_self_join = T_B is None
+    T_A = np.ascontiguousarray(T_A, dtype=float)
+    T_B = T_A if is_self_join else np.ascontiguousarray(T_B, dtype=float)
+    ms = np.asarray(ms, dtype=np.int64)
+    exclusions = np.ceil(ms / EXCLUSION_ZONE_DENOM).astype(np.int64)
+    # A self-join only walks the diagonals above the main one, each pair updating both of its subsequences
+    diags = np.arange(1, len(T_A)) if is_self_join else np.arange(-len(T_A) + 1, len(T_B))
+
+    sq_mp = np.full((len(ms), len(T_A) - ms.min() + 1), np.inf)
+    mp_idx = np.full(sq_mp.shape, -1, dtype=np.int64)
+    _multi_window_kernel(T_A, T_B, ms, exclusions, diags.astype(np.int64), is_self_join, sq_mp, mp_idx)
+    # Rolling sums may round slightly below zero
+    mp = np.sqrt(np.maximum(sq_mp, 0))
+    return {int(m): (mp[w, :len(T_A) - m + 1], mp_idx[w, :len(T_A) - m + 1]) for w, m in enumerate(ms)}
+
+
+def _cached_multi_window_join(kind, series, ms, mp_cache):
+    # series is [T_A] for a self-join or [T_A, T_B] for an AB-join, only the window lengths missing from the
+    # cache are computed. The kernel has its own key kinds, as its profiles differ from stumpy's by rounding
+    keys = {m: mp_cache.get_key(kind, m, *series) for m in ms} if mp_cache else {}
+    joins = {m: mp_cache.get(keys[m]) if mp_cache else None for m in ms}
+    missing = [m for m in ms if joins[m] is None]
+    if missing:
+        computed = _multi_window_join(series[0], missing, *series[1:])
+        for m in missing:
+            joins[m] = computed[m]
+            if mp_cache:
+                mp_cache.put(keys[m], *computed[m])
+    return joins
+
+
+def multi_window_joins(scaled_train_metrics, scaled_test_metrics, ms, mp_cache=None):
+    """The self-join of the training metrics and the AB-join of the test metrics for every window length in ms,
+    as {m: (train_mp, train_mp_idx, test_mp, test_mp_idx)}.
+
+    All the window lengths are computed in one pass over the diagonals of the distance matrix, sharing the
+    differences of the aligned points, and each of them only adds a running sum. The distances agree with
+    self_join and ab_join up to rounding, so they are cached apart from theirs. Without Numba, every m is joined
+    on its own with self_join and ab_join.
+    """
+    if mp_cache is None:
+        mp_cache = get_mp_cache()
+    ms = sorted(set(ms))
+    if _multi_window_kernel is None:
+        return {m: self_join(scaled_train_metrics, m, mp_cache) + ab_join(scaled_test_metrics, scaled_train_metrics,
+                                                                          m, mp_cache) for m in ms}
+
+    train_joins = _cached_multi_window_join('multi_self', [scaled_train_metrics], ms, mp_cache)
+    test_joins = _cached_multi_window_join('multi_ab', [scaled_test_metrics, scaled_train_metrics], ms, mp_cache)
+    return {m: tuple(train_joins[m]) + tuple(test_joins[m]) for m in ms}
@@ -0,0 +1,333 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .utils import *
+from .search import batch_nearest_pattern_search, get_subseqs
+from .adaptive import PatternBank
+from .background import BackgroundTask, NearestWindowModel
+from .checkpoint import load_checkpoint, save_checkpoint
+from .motif_operations import load_metric_patterns, offline_anomaly_detection
+from .pattern_store import load_header
+from .scaler import StreamingScaler
+
+
+class OnlineDetector:
+    """Push-based ADSketch detector that scores a metric stream one point at a time.
+
+    The learned patterns are loaded once and the last ``m`` scaled points are kept in a ring buffer,
+    so every pushed point costs O(k*m) for k patterns and memory does not grow with the stream length.
+
+    With checkpoint_path and checkpoint_every set, the whole state (the pattern bank, the scaler and the ring
+    buffer) is saved to checkpoint_path after every checkpoint_every pushed points, and load_checkpoint
+    resumes a detector from it without the offline patterns or the history of the stream.
+
+    max_cluster_num, eviction and merge_every bound the pattern bank of adaptive learning (see PatternBank). With
+    block_size set, push_many learns its windows in micro-batches of block_size instead of in the compiled kernel.
+
+    A detector from train_in_background scores the stream with a NearestWindowModel of the training windows
+    while its patterns are learned in a worker process, and switches to them at the first push after they are
+    ready. cluster_centers and the other patterns are None until then.
+    """
+
+    def __init__(self, m, cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters, scaler,
+                 adaptive_learning=False, max_anomalous_cluster_size=None, stride=1, index=None, index_params=None,
+                 block_size=None, checkpoint_path=None, checkpoint_every=None, max_cluster_num=None, eviction='lru',
+                 merge_every=None):
+        self.m = m
+        self.stride = stride
+        self.adaptive_learning = adaptive_learning
+        self.checkpoint_path, self.checkpoint_every = checkpoint_path, checkpoint_every
+        # The scaling is fixed by the training range, so every point is scaled on arrival
+        self.scaler = scaler if isinstance(scaler, StreamingScaler) else StreamingScaler.from_min_max_scaler(scaler)
+        self._bank_params = {'max_anomalous_cluster_size': max_anomalous_cluster_size, 'index': index,
+                             'index_params': index_params, 'block_size': block_size,
+                             'max_cluster_num': max_cluster_num, 'eviction': eviction, 'merge_every': merge_every}
+        self.bank = None
+        if cluster_centers is not None:
+            self._make_bank(cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters)
+        self._trainer = self._interim_model = self._pattern_file = None
+
+        # Each point is written twice so that the latest m points are always a contiguous slice
+        self._buffer = np.zeros(2 * m)
+        self.point_num = 0
+
+    def _make_bank(self, cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters):
+        self.bank = PatternBank(cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters,
+                                **self._bank_params)
+
+    @classmethod
+    def from_pattern_file(cls, offline_pattern_dir, m=None, train_metric_values=None, allow_pickle=True, clip=None,
+                          **kwargs):
+        """Load a detector from a pattern file, whose header gives m and the scaler, or from a legacy .pkl file
+        with m and the training values. clip is the clipping range of the scaled points (see StreamingScaler).
+        The other arguments, e.g. max_cluster_num, eviction and merge_every, are those of OnlineDetector."""
+        _, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii = load_metric_patterns(
+            offline_pattern_dir, allow_pickle)
+        if train_metric_values is None:
+            header = load_header(offline_pattern_dir)
+            m = m or header['m']
+            scaler = StreamingScaler.from_header(header, clip)
+        else:
+            scaler = StreamingScaler.from_metrics(train_metric_values, clip)
+        return cls(m, cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters, scaler, **kwargs)
+
+    @classmethod
+    def train_in_background(cls, m, p, train_metric_values, test_metric_values, test_metric_labels,
+                            offline_pattern_dir, fig_dir, dtype=None, clip=None, **kwargs):
+        """Start offline_anomaly_detection in a worker process and return a detector that scores the stream with
+        a NearestWindowModel of the training windows until the patterns saved to offline_pattern_dir are ready.
+
+        The windows pushed before then keep their interim verdicts and are not learned by adaptive learning. The
+        other arguments are those of OnlineDetector.
+        """
+        scaler = StreamingScaler.from_metrics(train_metric_values, clip)
+        detector = cls(m, None, None, None, None, scaler, **kwargs)
+        detector._trainer = BackgroundTask(offline_anomaly_detection, m, p, train_metric_values, test_metric_values,
+                                           test_metric_labels, offline_pattern_dir, fig_dir, dtype)
+        detector._interim_model = NearestWindowModel(scaler.transform(train_metric_values), m)
+        detector._pattern_file = offline_pattern_dir
+        return detector
+
+    @property
+    def patterns_ready(self):
+        """Whether the windows are scored by the learned patterns rather than by the interim model."""
+        self._swap_if_trained()
+        return self.bank is not None
+
+    def wait_for_patterns(self, timeout=None):
+        """Block until the patterns learned in the background are in use, raising the error of the worker if it
+        failed, or multiprocessing.TimeoutError after timeout seconds."""
+        if self._trainer is not None:
+            self._trainer.get(timeout)
+        self._swap_if_trained()
+
+    def _swap_if_trained(self):
+        if self._trainer is None or not self._trainer.ready():
+            return
+        # Raises the error of the worker, the scaler is the one the patterns were learned with
+        self._trainer.get()
+        _, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii = load_metric_patterns(
+            self._pattern_file)
+        self._make_bank(cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters)
+        self._trainer = self._interim_model = None
+
+    @classmethod
+    def load_checkpoint(cls, checkpoint_path, checkpoint_every=None, max_cluster_num=None, eviction=None,
+                        merge_every=None):
+        """Resume a detector from a checkpoint, saving later checkpoints to the same file.
+
+        max_cluster_num, eviction and merge_every replace the saved ones when given, a lower cap evicting clusters
+        learned online down to it.
+        """
+        header, arrays = load_checkpoint(checkpoint_path)
+        if header.get('kind') != 'online_detector':
+            raise ValueError(f'{checkpoint_path} is not a checkpoint of an online detector')
+        scaler = StreamingScaler(header['scaler_min'], header['scaler_max'], header['scaler_clip'])
+        scaler.out_of_range_num = header['out_of_range_num']
+        bank = PatternBank.from_state(header['bank'], arrays)
+        bank.configure(max_cluster_num or bank.max_cluster_num, eviction or bank.eviction,
+                       merge_every or bank.merge_every)
+        # The detector is built on the restored clusters without an index, then given the restored bank
+        detector = cls(header['m'], bank.centers, arrays['cluster_sizes'], arrays['cluster_radii'],
+                       bank.anomalous_clusters, scaler, header['adaptive_learning'],
+                       bank.max_anomalous_cluster_size, header['stride'], checkpoint_path=checkpoint_path,
+                       checkpoint_every=checkpoint_every, eviction=bank.eviction, merge_every=bank.merge_every)
+        detector.bank = bank
+        detector._buffer[:] = arrays['buffer']
+        detector.point_num = header['point_num']
+        return detector
+
+    def save_checkpoint(self, checkpoint_path=None):
+        """Save the state of the detector to checkpoint_path (default: the one it was created with)."""
+        checkpoint_path = checkpoint_path or self.checkpoint_path
+        if checkpoint_path is None:
+            raise ValueError('No checkpoint_path was given, here or when the detector was created')
+        if self.bank is None:
+            raise ValueError('The patterns are still being learned, there is no pattern bank to save yet')
+        bank_header, arrays = self.bank.get_state()
+        header = {'kind': 'online_detector', 'm': self.m, 'stride': self.stride,
+                  'adaptive_learning': self.adaptive_learning, 'point_num': self.point_num,
+                  'scaler_clip': self.scaler.clip, 'out_of_range_num': self.scaler.out_of_range_num,
+                  'bank': bank_header}
+        header.update(self.scaler.to_header())
+        save_checkpoint(checkpoint_path, header, dict(arrays, buffer=self._buffer))
+
+    def _checkpoint_if_due(self, point_num):
+        # Called with the point count before the last push
+        if self.checkpoint_path and self.checkpoint_every and self.bank is not None and \
+                self.point_num // self.checkpoint_every > point_num // self.checkpoint_every:
+            self.save_checkpoint()
+
+    @property
+    def anomalous_clusters(self):
+        return [] if self.bank is None else self.bank.anomalous_clusters
+
+    def _append(self, scaled_value):
+        pos = self.point_num % self.m
+        self._buffer[pos] = self._buffer[pos + self.m] = scaled_value
+        self.point_num += 1
+
+    def _history(self, point_num):
+        # The latest point_num (<= m) scaled points in chronological order
+        start = self.point_num % self.m + self.m - point_num
+        return self._buffer[start: start + point_num]
+
+    def push(self, value):
+        """Append one raw metric value and return True if the window ending at it is anomalous."""
+        point_num = self.point_num
+        verdict = self._push(value)
+        self._checkpoint_if_due(point_num)
+        return verdict
+
+    def _push(self, value):
+        m = self.m
+        self._append(self.scaler.transform_one(value))
+
+        start = self.point_num - m  # The start index of the newest subsequence in the stream
+        if start < 0 or start % self.stride != 0:
+            return False
+
+        subseq = self._buffer[self.point_num % m: self.point_num % m + m]
+        self._swap_if_trained()
+        if self.bank is None:
+            return bool(self._interim_model.is_anomalous(subseq[None])[0])
+        if self.adaptive_learning:
+            return bool(self.bank.learn(subseq, [0])[0])
+
+        if self.bank.index is not None:
+            return bool(self.bank.is_anomalous(subseq[None])[0])
+        dists = np.linalg.norm(self.bank.centers - subseq, axis=1)
+        return bool(self.bank.anomalous[np.argmin(dists)])
+
+    def push_many(self, values):
+        """Append a batch of raw metric values, e.g. one scrape, and return the verdict of the window ending at
+        each of them. The windows are scored in one pass, or learned in one call with adaptive learning."""
+        point_num = self.point_num
+        verdicts = self._push_many(values)
+        self._checkpoint_if_due(point_num)
+        return verdicts
+
+    def _push_many(self, values):
+        m = self.m
+        scaled_values = self.scaler.transform(values)
+        history_num = min(self.point_num, m - 1)
+        metrics = np.concatenate([self._history(history_num), scaled_values])
+
+        verdicts = np.zeros(len(scaled_values), dtype=bool)
+        window_num = len(metrics) - m + 1
+        if window_num > 0:
+            # The stream index where each window starts
+            starts = self.point_num - history_num + np.arange(window_num)
+            scored = np.where(starts % self.stride == 0)[0]
+            self._swap_if_trained()
+            if self.bank is None:
+                verdicts[scored + m - 1 - history_num] = self._interim_model.is_anomalous(
+                    get_subseqs(metrics, m)[scored])
+            elif self.adaptive_learning:
+                verdicts[scored + m - 1 - history_num] = self.bank.learn(metrics, scored)
+            else:
+                verdicts[scored + m - 1 - history_num] = self.bank.is_anomalous(get_subseqs(metrics, m)[scored])
+
+        self.point_num += max(len(scaled_values) - m, 0)
+        for scaled_value in scaled_values[-m:]:
+            self._append(scaled_value)
+
+        return verdicts
+
+
+class MultiWindowDetector:
+    """Scores one metric stream against the patterns of several window lengths, e.g. from
+    multi_window_pattern_discovery, with one OnlineDetector per m. Verdicts are returned per m as {m: verdict}.
+    """
+
+    def __init__(self, detectors):
+        self.detectors = {detector.m: detector for detector in detectors}
+
+    @classmethod
+    def from_patterns(cls, patterns, scaler, **kwargs):
+        """Build a detector for every m of patterns, {m: patterns of anomaly_pattern_discovery}, scaling the points
+        like scaler. The other arguments are those of OnlineDetector."""
+        # Every detector counts its own out-of-range points
+        return cls([OnlineDetector(m, cluster_centers, cluster_sizes, cluster_radii, anomalous_clusters,
+                                   StreamingScaler(scaler.data_min, scaler.data_max, scaler.clip), **kwargs)
+                    for m, (_, anomalous_clusters, cluster_sizes, cluster_centers, cluster_radii) in patterns.items()])
+
+    @classmethod
+    def from_pattern_files(cls, offline_pattern_dirs, **kwargs):
+        return cls([OnlineDetector.from_pattern_file(offline_pattern_dir, **kwargs)
+                    for offline_pattern_dir in offline_pattern_dirs])
+
+    def push(self, value):
+        return {m: detector.push(value) for m, detector in self.detectors.items()}
+
+    def push_many(self, values):
+        return {m: detector.push_many(values) for m, detector in self.detectors.items()}
+
+
+class MultiSeriesDetector:
+    """Non-adaptive detection of many metric streams that share m, scored together at every tick.
+
+    Every metric keeps its own patterns and scaler. The centers are padded to the largest bank and the padding
+    is masked out, so that the windows of all the metrics are scored by one batched matrix product (see
+    batch_nearest_pattern_search). Missing values (NaN), e.g. the padding of series of different lengths, leave
+    the windows that contain them unscored.
+    """
+
+    def __init__(self, m, cluster_centers, anomalous_clusters, scalers):
+        # cluster_centers, anomalous_clusters and scalers hold one entry per metric
+        self.m = m
+        self.metric_num = len(cluster_centers)
+        center_nums = [len(centers) for centers in cluster_centers]
+        # At least one (masked) center, so that a metric without patterns is never anomalous
+        self.centers = np.zeros((self.metric_num, max(center_nums + [1]), m))
+        self.center_mask = np.zeros(self.centers.shape[:2], dtype=bool)
+        self.anomalous = np.zeros(self.centers.shape[:2], dtype=bool)
+        for metric_id, (centers, clusters) in enumerate(zip(cluster_centers, anomalous_clusters)):
+            self.centers[metric_id, :center_nums[metric_id]] = np.asarray(centers).reshape(-1, m)
+            self.center_mask[metric_id, :center_nums[metric_id]] = True
+            self.anomalous[metric_id, np.asarray(clusters, dtype=np.int64)] = True
+
+        scalers = [scaler if isinstance(scaler, StreamingScaler) else StreamingScaler.from_min_max_scaler(scaler)
+                   for scaler in scalers]
+        self.scale = np.array([scaler.scale for scaler in scalers])
+        self.offset = np.array([scaler.offset for scaler in scalers])
+        self.clip_low = np.array([-np.inf if scaler.clip is None else scaler.clip[0] for scaler in scalers])
+        self.clip_high = np.array([np.inf if scaler.clip is None else scaler.clip[1] for scaler in scalers])
+        self.out_of_range_nums = np.zeros(self.metric_num, dtype=np.int64)
+
+        # The last m - 1 scaled points of every metric, NaN before the stream starts
+        self._history = np.full((self.metric_num, m - 1), np.nan)
+        self.point_num = 0
+
+    @classmethod
+    def from_detectors(cls, detectors):
+        """Batch the patterns and scalers of OnlineDetectors, e.g. loaded with OnlineDetector.from_pattern_file."""
+        return cls(detectors[0].m, [detector.bank.centers for detector in detectors],
+                   [detector.bank.anomalous_clusters for detector in detectors],
+                   [detector.scaler for detector in detectors])
+
+    def _scale(self, values):
+        scaled_values = values * self.scale[:, None] + self.offset[:, None]
+        out_of_range = (scaled_values < self.clip_low[:, None]) | (scaled_values > self.clip_high[:, None])
+        self.out_of_range_nums += np.count_nonzero(out_of_range, axis=1)
+        return np.clip(scaled_values, self.clip_low[:, None], self.clip_high[:, None])
+
+    def push(self, values):
+        """Append one raw value per metric and return whether the window ending at each of them is anomalous."""
+        return self.push_many(np.asarray(values, dtype=float)[:, None])[:, 0]
+
+    def push_many(self, values):
+        """Append a (metric_num, point_num) block of raw values and return the verdict of the window ending at
+        each of them."""
+        m = self.m
+        values = np.asarray(values, dtype=float).reshape(self.metric_num, -1)
+        metrics = np.concatenate([self._history, self._scale(values)], axis=1)
+        subseqs = sliding_window_view(metrics, m, axis=1)
+
+        nearest_patterns, _ = batch_nearest_pattern_search(subseqs, self.centers, self.center_mask)
+        verdicts = self.anomalous[np.arange(self.metric_num)[:, None], nearest_patterns]
+        verdicts &= ~np.isnan(subseqs).any(axis=2)
+
+        self._history = metrics[:, metrics.shape[1] - (m - 1):]
+        self.point_num += values.shape[1]
+        return verdicts
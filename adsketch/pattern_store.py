@@ -0,0 +1,95 @@
+import os
+import json
+import struct
+import tempfile
+
+import numpy as np
+
+# A pattern file is the magic, the schema version and the header length, a JSON header, then the arrays.
+# Every array starts on an ALIGNMENT boundary so that it can be used in place from a memory map.
+PATTERN_MAGIC = b'ADSKPAT\x00'
+PATTERN_VERSION = 1
+PATTERN_FILE_EXT = '.adsp'
+ALIGNMENT = 64
+PREFIX = struct.Struct('<8sII')
+
+# The float arrays are saved as '<f4' when the centers are float32
+PATTERN_ARRAYS = [('anomalous_subseqs', '<i8'), ('anomalous_clusters', '<i8'), ('cluster_sizes', '<i8'),
+                  ('cluster_centers', '<f8'), ('cluster_radii', '<f8')]
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def find_pattern_file(path):
+    """Return path if it exists, else the legacy pickle next to it if that exists, else None."""
+    if os.path.exists(path):
+        return path
+    legacy_path = os.path.splitext(path)[0] + '.pkl'
+    if os.path.exists(legacy_path):
+        return legacy_path
+    return None
+
+
+def is_pattern_file(path):
+    with open(path, 'rb') as reader:
+        return reader.read(len(PATTERN_MAGIC)) == PATTERN_MAGIC
+
+
+def save_patterns(path, header, anomalous_subseqs, anomalous_clusters, cluster_sizes, cluster_centers,
+                  cluster_radii):
+    """Write the learned patterns and a header (m, p, scaler min/max...) to a pattern file, atomically."""
+    m = header['m']
+    arrays = [np.asarray(anomalous_subseqs), np.asarray(anomalous_clusters), np.asarray(cluster_sizes),
+              np.asarray(cluster_centers).reshape(-1, m), np.asarray(cluster_radii)]
+    float_dtype = '<f4' if arrays[3].dtype == np.float32 else '<f8'
+    arrays = [np.ascontiguousarray(array, dtype=float_dtype if dtype == '<f8' else dtype)
+              for array, (_, dtype) in zip(arrays, PATTERN_ARRAYS)]
+
+    # The offsets depend on the header length, which depends on the offsets: lay the arrays out after a
+    # header padded to a whole number of ALIGNMENT blocks until it fits
+    header_size = ALIGNMENT
+    while True:
+        offset, specs = header_size, {}
+        for array, (name, _) in zip(arrays, PATTERN_ARRAYS):
+            specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset = _align(offset + array.nbytes)
+        header_bytes = json.dumps(dict(header, version=PATTERN_VERSION, arrays=specs)).encode()
+        if PREFIX.size + len(header_bytes) <= header_size:
+            break
+        header_size = _align(PREFIX.size + len(header_bytes))
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as writer:
+        writer.write(PREFIX.pack(PATTERN_MAGIC, PATTERN_VERSION, len(header_bytes)))
+        writer.write(header_bytes)
+        for array, (name, _) in zip(arrays, PATTERN_ARRAYS):
+            writer.write(b'\x00' * (specs[name]['offset'] - writer.tell()))
+            writer.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_header(path):
+    with open(path, 'rb') as reader:
+        magic, version, header_len = PREFIX.unpack(reader.read(PREFIX.size))
+        if magic != PATTERN_MAGIC:
+            raise ValueError(f'{path} is not a pattern file')
+        if version > PATTERN_VERSION:
+            raise ValueError(f'{path} has schema version {version}, newer than the supported {PATTERN_VERSION}')
+        return json.loads(reader.read(header_len))
+
+
+def load_patterns(path):
+    """Return the header and the arrays of a pattern file, the arrays being read-only views of one memory map."""
+    header = load_header(path)
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, _ in PATTERN_ARRAYS:
+        spec = header['arrays'][name]
+        if np.prod(spec['shape']) == 0:
+            arrays[name] = np.empty(spec['shape'], dtype=spec['dtype'])
+        else:
+            arrays[name] = np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=buffer, offset=spec['offset'])
+
+    return header, arrays
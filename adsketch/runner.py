@@ -0,0 +1,177 @@
+import os
+import json
+import argparse
+import multiprocessing
+
+import pandas as pd
+
+from .utils import *
+from .executor import get_available_cores
+from .motif_operations import offline_anomaly_detection
+from .pattern_store import PATTERN_FILE_EXT
+
+# The first TRAIN_NUM points of every benchmark series are anomaly-free and used for training
+TRAIN_NUM = 300
+# The (m, p) of the metrics not tuned in params.json
+DEFAULT_PARAMS = {'throughput': (50, 10), 'error_rate': (50, 10)}
+DEFAULT_M, DEFAULT_P = 5, 99
+
+DATASET_TITLES = {'cpu_usage': 'CPU Usage', 'memory_usage': 'Memory Usage', 'latency': 'Latency',
+                  'throughput': 'Throughput', 'error_rate': 'Error Rate', 'page_load': 'Page Load Time',
+                  'request_count': 'Request Count', 'response_time': 'Response Time'}
+
+
+def load_benchmark_data(data_dir):
+    """Load the values and labels of every CSV file in a benchmark directory, sorted by file name."""
+    metric_values, metric_labels = [], []
+    for file in sorted([f for f in os.listdir(data_dir) if f.endswith('.csv')]):
+        df = pd.read_csv(os.path.join(data_dir, file))
+        metric_values.append(df['value'].values)
+        metric_labels.append(df['is_anomaly'].values)
+
+    return metric_values, metric_labels
+
+
+def _init_worker(thread_num):
+    # Every worker owns a share of the cores, so that the threads of stumpy do not oversubscribe them
+    try:
+        import numba
+        numba.set_num_threads(thread_num)
+    except ImportError:
+        pass
+
+
+def detect_metric(task):
+    """Run offline anomaly detection on one metric, returning its scores or the error that stopped it."""
+    metric_name, m, p, discovery_params, metric_values, metric_labels, train_num, res_dir, pattern_dir = task
+    logging.info('=' * 60)
+    logging.info(f'Metric: {metric_name}, m: {m}, p: {p}')
+    fig_dir = os.path.join(res_dir, f'{metric_name}_{m}_{p}.png')
+    offline_pattern_dir = os.path.join(pattern_dir, f'{metric_name}_{m}_{p}{PATTERN_FILE_EXT}')
+
+    try:
+        precision, recall, f1 = offline_anomaly_detection(m, p,
+                                                          metric_values[:train_num], metric_values[train_num:],
+                                                          metric_labels[train_num:], offline_pattern_dir, fig_dir,
+                                                          **discovery_params)
+    except Exception as e:
+        logging.exception(f'Metric {metric_name} failed')
+        return {'metric_name': metric_name, 'error': repr(e)}
+
+    return {'metric_name': metric_name, 'precision': precision, 'recall': recall, 'f1': f1}
+
+
+def run_benchmark(dataset, data_dir=None, params_path='params.json', res_dir=None, pattern_dir=None,
+                  process_num=None, train_num=TRAIN_NUM, dtype=None):
+    """Run offline anomaly detection on every metric of a benchmark dataset over a process pool.
+
+    The per-metric scores are written once to <res_dir>/<dataset>_results.csv and returned as a DataFrame.
+    dtype=np.float32 runs the metrics in float32 (see offline_anomaly_detection).
+    """
+    data_dir = data_dir or f'data/{dataset}_benchmark'
+    res_dir = res_dir or f'./res/{dataset}/'
+    pattern_dir = pattern_dir or f'./offline_metrics/{dataset}/'
+    os.makedirs(res_dir, exist_ok=True)
+    os.makedirs(pattern_dir, exist_ok=True)
+
+    with open(params_path, 'r') as json_reader:
+        dataset_params = json.load(json_reader).get(dataset, {})
+    default_m, default_p = DEFAULT_PARAMS.get(dataset, (DEFAULT_M, DEFAULT_P))
+    title = DATASET_TITLES.get(dataset, dataset)
+    logging.info('{}{}{}'.format('^' * 15, f' Offline anomaly detection for {title} dataset ', '^' * 15))
+
+    metric_values, metric_labels = load_benchmark_data(data_dir)
+    tasks = []
+    for metric_id in range(len(metric_values)):
+        # Metrics are named by their position among the sorted files, as in params.json
+        metric_name = f'{dataset}_{metric_id + 1}'
+        metric_params = dataset_params.get(metric_name, {})
+        m, p = metric_params.get('m', default_m), metric_params.get('p', default_p)
+        # The other discovery parameters a sweep may have tuned (see sweep.py)
+        discovery_params = {key: metric_params[key] for key in ('noise_p', 'damping') if key in metric_params}
+        if dtype is not None:
+            discovery_params['dtype'] = dtype
+        tasks.append((metric_name, m, p, discovery_params, metric_values[metric_id], metric_labels[metric_id],
+                      train_num, res_dir, pattern_dir))
+
+    process_num = min(process_num or get_available_cores(), len(tasks)) or 1
+    results = {}
+    scores = np.zeros(3)
+    if process_num == 1:
+        result_iter = map(detect_metric, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(process_num, initializer=_init_worker,
+                                    initargs=(max(1, get_available_cores() // process_num),))
+        result_iter = pool.imap_unordered(detect_metric, tasks)
+
+    try:
+        for result in result_iter:
+            results[result['metric_name']] = result
+            if 'error' not in result:
+                scores += [result['precision'], result['recall'], result['f1']]
+            done = sum('error' not in result for result in results.values())
+            logging.info('[{}/{}] {}, running mean precision: {:.3f}, recall: {:.3f}, f1: {:.3f}'.format(
+                len(results), len(tasks), result['metric_name'], *(scores / max(done, 1))))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results_df = pd.DataFrame([results[task[0]] for task in tasks])
+    failed = results_df['error'].notna() if 'error' in results_df else np.zeros(len(results_df), dtype=bool)
+    mean_scores = results_df.loc[~failed, ['precision', 'recall', 'f1']].mean()
+
+    logging.info('{}{}{}'.format('^' * 15, f' Experimental results of {title} dataset ', '^' * 15))
+    if failed.any():
+        logging.info(f'Failed metrics: {", ".join(results_df.loc[failed, "metric_name"])}')
+    logging.info('precision: {:.3f}, recall: {:.3f}, f1: {:.3f}'.format(*mean_scores))
+
+    print("\n" + "=" * 50)
+    print(f"Average Metrics for All {title} Data:")
+    print("-" * 50)
+    print(f"Average Precision: {mean_scores['precision']:.3f}")
+    print(f"Average Recall: {mean_scores['recall']:.3f}")
+    print(f"Average F1-Score: {mean_scores['f1']:.3f}")
+    print("=" * 50)
+
+    results_file = os.path.join(res_dir, f'{dataset}_results.csv')
+    results_df.to_csv(results_file, index=False)
+    print(f"\nDetailed results saved to: {results_file}")
+
+    return results_df
+
+
+def get_parser(dataset=None):
+    parser = argparse.ArgumentParser(description='Offline anomaly detection over a benchmark dataset')
+    if dataset is None:
+        parser.add_argument("dataset", type=str, help="The benchmark name, e.g. cpu_usage")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="The directory of the metric CSV files (default: data/<dataset>_benchmark)")
+    parser.add_argument("--params", type=str, default='params.json', help="The tuned parameters of every metric")
+    parser.add_argument("--res_dir", type=str, default=None if dataset is None else f'./res/{dataset}/',
+                        help="The directory to save experimental figures")
+    parser.add_argument("--pattern_dir", type=str,
+                        default=None if dataset is None else f'./offline_metrics/{dataset}/',
+                        help="The directory to save the learned metric patterns and other necessary info")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="The number of metrics processed in parallel (default: all available cores)")
+    parser.add_argument("--float32", action='store_true',
+                        help="Scale, cluster and save the patterns in float32 to halve their memory")
+    return parser
+
+
+def main(dataset=None):
+    args = vars(get_parser(dataset).parse_args())
+    dataset = dataset or args['dataset']
+
+    seed_everything(seed=1234)
+    os.makedirs('./logs', exist_ok=True)
+    init_logging(f'./logs/{dataset}_demo.log')
+
+    return run_benchmark(dataset, args['data_dir'], args['params'], args['res_dir'], args['pattern_dir'],
+                         args['processes'], dtype=np.float32 if args['float32'] else None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import numpy as np
+
+# Clip scaled values to the range of the training data
+CLIP_UNIT = (0., 1.)
+
+
+class StreamingScaler:
+    """Min-max scaling fixed by the range of the training data and applied point by point or in batches.
+
+    It gives the same values as a MinMaxScaler fitted on the training data, without the (-1, 1) reshapes. With
+    clip set to a (low, high) range in scaled units, e.g. CLIP_UNIT, out-of-range values are clipped and counted
+    in out_of_range_num; by default they are scaled like any other value.
+    """
+
+    def __init__(self, data_min, data_max, clip=None):
+        self.data_min, self.data_max = float(data_min), float(data_max)
+        self.clip = None if clip is None else (float(clip[0]), float(clip[1]))
+        self.out_of_range_num = 0
+        # The float64 transform, kept for scaling single points
+        self.scale, self.offset = (float(value) for value in self.get_affine())
+
+    @classmethod
+    def from_metrics(cls, train_metric_values, clip=None):
+        train_metric_values = np.asarray(train_metric_values)
+        return cls(np.min(train_metric_values), np.max(train_metric_values), clip)
+
+    @classmethod
+    def from_min_max_scaler(cls, est, clip=None):
+        return cls(est.data_min_[0], est.data_max_[0], clip)
+
+    @classmethod
+    def from_header(cls, header, clip=None):
+        return cls(header['scaler_min'], header['scaler_max'], clip)
+
+    def to_header(self):
+        return {'scaler_min': self.data_min, 'scaler_max': self.data_max}
+
+    def get_affine(self, dtype=np.float64):
+        # Computed in the working precision, as MinMaxScaler does, and a constant range is mapped to 0
+        data_min, data_max = dtype(self.data_min), dtype(self.data_max)
+        data_range = data_max - data_min
+        scale = dtype(1) / data_range if data_range != 0 else dtype(1)
+        return scale, -data_min * scale
+
+    def transform(self, metric_values, out=None):
+        """Scale an array of values, keeping float32 input in float32."""
+        metric_values = np.asarray(metric_values)
+        if metric_values.dtype not in (np.float32, np.float64):
+            metric_values = metric_values.astype(np.float64)
+        dtype = metric_values.dtype.type
+        scale, offset = self.get_affine(dtype)
+
+        out = np.multiply(metric_values, scale, out=out)
+        out += offset
+        if self.clip is not None:
+            low, high = dtype(self.clip[0]), dtype(self.clip[1])
+            self.out_of_range_num += int(np.count_nonzero((out < low) | (out > high)))
+            np.clip(out, low, high, out=out)
+        return out
+
+    def transform_one(self, value):
+        scaled_value = value * self.scale + self.offset
+        if self.clip is not None and not self.clip[0] <= scaled_value <= self.clip[1]:
+            self.out_of_range_num += 1
+            scaled_value = min(max(scaled_value, self.clip[0]), self.clip[1])
+        return scaled_value
@@ -0,0 +1,168 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# The working set of one tile (subsequences plus their distances to every center) is kept around this size
+TILE_BYTES = 1 << 22
+# The number of segment means (PAA) per subsequence used to lower-bound its distance to the centers
+PAA_SEGMENT_NUM = 8
+# Lower bounds are only trusted up to this relative rounding error
+LOWER_BOUND_TOLERANCE = 1e-9
+
+
+def get_subseqs(metrics, m, stride=1):
+    # A zero-copy (n - m + 1, m) view of all the subsequences
+    return sliding_window_view(metrics, m)[::stride]
+
+
+def get_tile_size(m, center_num, itemsize=8):
+    return max(64, TILE_BYTES // (itemsize * (m + center_num)))
+
+
+def nearest_pattern_search(subseqs, centers, tile_size=None):
+    """Find the nearest center of every subsequence with ||a||^2 - 2a.b + ||b||^2 matrix products.
+
+    Returns the index of the nearest center and the (exact) Euclidean distance to it as arrays.
+    """
+    centers = np.ascontiguousarray(centers, dtype=subseqs.dtype)
+    center_num, m = centers.shape
+    subseq_num = len(subseqs)
+    if tile_size is None:
+        tile_size = get_tile_size(m, center_num, centers.itemsize)
+
+    center_norms = np.einsum('ij,ij->i', centers, centers)
+    nearest_patterns = np.empty(subseq_num, dtype=np.int64)
+    nearest_dists = np.empty(subseq_num, dtype=subseqs.dtype)
+
+    for start in range(0, subseq_num, tile_size):
+        end = min(start + tile_size, subseq_num)
+        tile = np.ascontiguousarray(subseqs[start: end])
+
+        sq_dists = tile @ centers.T
+        sq_dists *= -2
+        sq_dists += center_norms
+        # ||a||^2 is constant along each row and does not change the argmin
+        nearest = np.argmin(sq_dists, axis=1)
+        nearest_patterns[start: end] = nearest
+        # Recompute the winning distances directly to avoid the cancellation error of the identity
+        nearest_dists[start: end] = np.linalg.norm(tile - centers[nearest], axis=1)
+
+    return nearest_patterns, nearest_dists
+
+
+def batch_nearest_pattern_search(subseqs, centers, center_mask=None, tile_size=None):
+    """nearest_pattern_search for a batch of series with their own centers, (series_num, subseq_num, m)
+    subseqs and (series_num, center_num, m) centers.
+
+    Banks of different sizes are padded to the largest one, with center_mask False on the padding. Every tile
+    of subsequences of all the series is scored by one batched matrix product.
+    """
+    dtype = np.result_type(subseqs, np.float32)
+    centers = np.ascontiguousarray(centers, dtype=dtype)
+    series_num, center_num, m = centers.shape
+    subseq_num = subseqs.shape[1]
+    if tile_size is None:
+        tile_size = max(1, TILE_BYTES // (centers.itemsize * series_num * (m + center_num)))
+
+    center_norms = np.einsum('ijk,ijk->ij', centers, centers)
+    if center_mask is not None:
+        # A padded center is never the nearest one
+        center_norms = np.where(center_mask, center_norms, np.inf).astype(dtype)
+    nearest_patterns = np.empty((series_num, subseq_num), dtype=np.int64)
+    nearest_dists = np.empty((series_num, subseq_num), dtype=dtype)
+    series_idxes = np.arange(series_num)[:, None]
+
+    for start in range(0, subseq_num, tile_size):
+        end = min(start + tile_size, subseq_num)
+        tile = np.ascontiguousarray(subseqs[:, start: end], dtype=dtype)
+
+        sq_dists = tile @ centers.transpose(0, 2, 1)
+        sq_dists *= -2
+        sq_dists += center_norms[:, None]
+        nearest = np.argmin(sq_dists, axis=2)
+        nearest_patterns[:, start: end] = nearest
+        nearest_dists[:, start: end] = np.linalg.norm(tile - centers[series_idxes, nearest], axis=2)
+
+    return nearest_patterns, nearest_dists
+
+
+def get_segment_bounds(m, segment_num=PAA_SEGMENT_NUM):
+    return np.unique(np.linspace(0, m, min(segment_num, m) + 1).astype(np.int64))
+
+
+def get_paa(subseqs, segment_bounds):
+    # The mean of every segment of the subsequences (Piecewise Aggregate Approximation)
+    return np.add.reduceat(subseqs, segment_bounds[:-1], axis=1) / np.diff(segment_bounds)
+
+
+def _pruned_search_loop(metrics, starts, centers, center_paa, segment_bounds, nearest_patterns, nearest_dists):
+    # For segments of width w, w * (mean(a) - mean(b))^2 <= ||a - b||^2 over the segment, so the weighted PAA
+    # distance lower-bounds the squared distance and a center is skipped when its bound exceeds the best one.
+    # The remaining distances are abandoned as soon as their partial sum exceeds the best one.
+    center_num, m = centers.shape
+    segment_num = len(segment_bounds) - 1
+    subseq_paa = np.empty(segment_num)
+    nearest_pattern = 0
+    for t in range(len(starts)):
+        start = starts[t]
+        for g in range(segment_num):
+            segment_sum = 0.0
+            for j in range(segment_bounds[g], segment_bounds[g + 1]):
+                segment_sum += metrics[start + j]
+            subseq_paa[g] = segment_sum / (segment_bounds[g + 1] - segment_bounds[g])
+
+        # Overlapping subsequences tend to share their nearest center, which gives a tight bound to start with
+        best_sq_dist = 0.0
+        for j in range(m):
+            diff = centers[nearest_pattern, j] - metrics[start + j]
+            best_sq_dist += diff * diff
+        guess = nearest_pattern
+
+        for c in range(center_num):
+            if c == guess:
+                continue
+            lower_bound = 0.0
+            for g in range(segment_num):
+                diff = subseq_paa[g] - center_paa[c, g]
+                lower_bound += (segment_bounds[g + 1] - segment_bounds[g]) * diff * diff
+            if lower_bound > best_sq_dist * (1 + LOWER_BOUND_TOLERANCE):
+                continue
+
+            sq_dist = 0.0
+            for j in range(m):
+                diff = centers[c, j] - metrics[start + j]
+                sq_dist += diff * diff
+                if sq_dist > best_sq_dist:
+                    break
+            # Ties go to the lower index, as with np.argmin
+            if sq_dist < best_sq_dist or (sq_dist == best_sq_dist and c < nearest_pattern):
+                nearest_pattern, best_sq_dist = c, sq_dist
+
+        nearest_patterns[t] = nearest_pattern
+        nearest_dists[t] = np.sqrt(best_sq_dist)
+
+
+_pruned_search_kernel = njit(cache=True, nogil=True)(_pruned_search_loop) if njit is not None else None
+
+
+def pruned_pattern_search(metrics, m, centers, stride=1, segment_num=PAA_SEGMENT_NUM):
+    """Exact nearest-pattern search with PAA lower bounds and early abandoning, for long subsequences.
+
+    It needs Numba and falls back to nearest_pattern_search without it.
+    """
+    metrics = np.ascontiguousarray(metrics, dtype=float)
+    centers = np.ascontiguousarray(centers, dtype=float)
+    if _pruned_search_kernel is None:
+        return nearest_pattern_search(get_subseqs(metrics, m, stride), centers)
+
+    starts = np.arange(0, len(metrics) - m + 1, stride)
+    segment_bounds = get_segment_bounds(m, segment_num)
+    nearest_patterns = np.empty(len(starts), dtype=np.int64)
+    nearest_dists = np.empty(len(starts))
+    _pruned_search_kernel(metrics, starts, centers, get_paa(centers, segment_bounds), segment_bounds,
+                          nearest_patterns, nearest_dists)
+    return nearest_patterns, nearest_dists
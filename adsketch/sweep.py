@@ -0,0 +1,183 @@
+import os
+import json
+import argparse
+import itertools
+import multiprocessing
+
+import pandas as pd
+
+from .utils import *
+from .executor import get_available_cores
+from .matrix_profile import ab_join, self_join
+from .motif_operations import discover_patterns, evaluate
+from .runner import TRAIN_NUM, _init_worker, load_benchmark_data
+
+# The discovery parameters that params.json only records when they differ from these
+DEFAULT_NOISE_P, DEFAULT_DAMPING = 100, 0.9
+
+
+def sweep_metric(task):
+    """Score every (p, noise_p, damping) of one metric with one m, computing the matrix profiles once."""
+    metric_name, m, grid, metric_values, metric_labels, train_num, mp_cache = task
+    scaled_train_metrics, scaled_test_metrics = scale_two_metrics(metric_values[:train_num],
+                                                                  metric_values[train_num:])
+    test_metric_labels = metric_labels[train_num:]
+
+    try:
+        mps = self_join(scaled_train_metrics, m, mp_cache) + ab_join(scaled_test_metrics, scaled_train_metrics, m,
+                                                                     mp_cache)
+    except Exception:
+        logging.exception(f'Matrix profiles of {metric_name} failed with m: {m}')
+        mps = None
+
+    trials = []
+    for p, noise_p, damping in grid:
+        scores = [np.nan] * 3
+        if mps is not None:
+            try:
+                anomalous_subseqs = discover_patterns(scaled_train_metrics, scaled_test_metrics, m, *mps, p, noise_p,
+                                                      damping)[0]
+                scores = evaluate(m, anomalous_subseqs, test_metric_labels)
+            except Exception:
+                logging.exception(f'Trial of {metric_name} failed with m: {m}, p: {p}, noise_p: {noise_p}, '
+                                  f'damping: {damping}')
+        trials.append(dict(zip(['metric_name', 'm', 'p', 'noise_p', 'damping', 'precision', 'recall', 'f1'],
+                               [metric_name, m, p, noise_p, damping, *scores])))
+
+    return trials
+
+
+def _json_number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def get_best_trials(trials_df):
+    """The trial with the best F1 of every metric, ties going to the first trial of the grid."""
+    scored = trials_df[trials_df['f1'].notna()]
+    return scored.loc[scored.groupby('metric_name', sort=False)['f1'].idxmax()]
+
+
+def get_trial_params(trial):
+    params = {'m': int(trial['m']), 'p': _json_number(trial['p'])}
+    if trial['noise_p'] != DEFAULT_NOISE_P:
+        params['noise_p'] = _json_number(trial['noise_p'])
+    if trial['damping'] != DEFAULT_DAMPING:
+        params['damping'] = _json_number(trial['damping'])
+    return params
+
+
+def dump_params(params, params_path):
+    # The layout of params.json: one line per metric
+    datasets = []
+    for dataset, metric_params in params.items():
+        metric_lines = ',\n'.join(f'    {json.dumps(name)}: {json.dumps(values)}'
+                                  for name, values in metric_params.items())
+        datasets.append(f'  {json.dumps(dataset)}: {{\n{metric_lines}\n  }}')
+
+    with open(params_path, 'w') as json_writer:
+        json_writer.write('{\n' + ',\n'.join(datasets) + '\n}\n')
+
+
+def update_params(dataset, best_params, params_path):
+    """Write the best parameters into a params.json file, keeping the other datasets and keys (e.g. seg)."""
+    params = {}
+    if os.path.exists(params_path):
+        with open(params_path, 'r') as json_reader:
+            params = json.load(json_reader)
+
+    dataset_params = params.setdefault(dataset, {})
+    for metric_name, best in best_params.items():
+        metric_params = dataset_params.setdefault(metric_name, {})
+        for key in ('noise_p', 'damping'):
+            metric_params.pop(key, None)
+        metric_params.update(best)
+
+    dump_params(params, params_path)
+
+
+def sweep_benchmark(dataset, ms, ps, noise_ps=(DEFAULT_NOISE_P,), dampings=(DEFAULT_DAMPING,), data_dir=None,
+                    res_dir=None, params_out=None, process_num=None, train_num=TRAIN_NUM, mp_cache=None):
+    """Grid-search m, p, noise_p and damping over every metric of a benchmark dataset.
+
+    Every (metric, m) pair is one task of the process pool, whose matrix profiles are shared by all its trials.
+    All the trials are written to <res_dir>/<dataset>_sweep.csv and the best parameters of every metric to
+    params_out (default <res_dir>/<dataset>_params.json) in the format of params.json.
+    """
+    data_dir = data_dir or f'data/{dataset}_benchmark'
+    res_dir = res_dir or f'./res/{dataset}/'
+    params_out = params_out or os.path.join(res_dir, f'{dataset}_params.json')
+    os.makedirs(res_dir, exist_ok=True)
+
+    grid = list(itertools.product(ps, noise_ps, dampings))
+    metric_values, metric_labels = load_benchmark_data(data_dir)
+    metric_names = [f'{dataset}_{metric_id + 1}' for metric_id in range(len(metric_values))]
+    tasks = [(metric_names[metric_id], m, grid, metric_values[metric_id], metric_labels[metric_id], train_num,
+              mp_cache) for metric_id in range(len(metric_values)) for m in ms]
+    logging.info(f'Sweeping {len(metric_names)} metrics of {dataset} over {len(ms)} m and {len(grid)} '
+                 f'(p, noise_p, damping)')
+
+    process_num = min(process_num or get_available_cores(), len(tasks)) or 1
+    if process_num == 1:
+        pool = None
+        result_iter = map(sweep_metric, tasks)
+    else:
+        pool = multiprocessing.Pool(process_num, initializer=_init_worker,
+                                    initargs=(max(1, get_available_cores() // process_num),))
+        result_iter = pool.imap_unordered(sweep_metric, tasks)
+
+    results = {}
+    try:
+        for trials in result_iter:
+            results[trials[0]['metric_name'], trials[0]['m']] = trials
+            logging.info('[{}/{}] {}, m: {}, best f1: {:.3f}'.format(
+                len(results), len(tasks), trials[0]['metric_name'], trials[0]['m'],
+                np.nanmax([trial['f1'] for trial in trials] + [-np.inf])))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # In the order of the grid, so that ties go to the first trial
+    trials_df = pd.DataFrame([trial for task in tasks for trial in results[task[0], task[1]]])
+    trials_df.to_csv(os.path.join(res_dir, f'{dataset}_sweep.csv'), index=False)
+
+    best_trials = get_best_trials(trials_df)
+    best_params = {trial['metric_name']: get_trial_params(trial) for _, trial in best_trials.iterrows()}
+    update_params(dataset, best_params, params_out)
+    if len(best_trials):
+        logging.info('Best parameters written to {}, mean precision: {:.3f}, recall: {:.3f}, f1: {:.3f}'.format(
+            params_out, *best_trials[['precision', 'recall', 'f1']].mean()))
+
+    return trials_df, best_params
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parameter sweep over a benchmark dataset')
+    parser.add_argument("dataset", type=str, help="The benchmark name, e.g. cpu_usage")
+    parser.add_argument("--m", type=int, nargs='+', default=[3, 5, 7, 10], help="The subsequence lengths")
+    parser.add_argument("--p", type=float, nargs='+', default=[95, 98, 99, 99.5], help="The percentiles of the test MP")
+    parser.add_argument("--noise_p", type=float, nargs='+', default=[DEFAULT_NOISE_P],
+                        help="The percentiles of the training MP")
+    parser.add_argument("--damping", type=float, nargs='+', default=[DEFAULT_DAMPING],
+                        help="The damping factors of Affinity Propagation")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="The directory of the metric CSV files (default: data/<dataset>_benchmark)")
+    parser.add_argument("--res_dir", type=str, default=None, help="The directory to save the trials")
+    parser.add_argument("--params_out", type=str, default=None,
+                        help="The params.json file to write the best parameters into "
+                             "(default: <res_dir>/<dataset>_params.json)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="The number of (metric, m) tasks processed in parallel (default: all available cores)")
+    args = vars(parser.parse_args())
+
+    seed_everything(seed=1234)
+    os.makedirs('./logs', exist_ok=True)
+    init_logging(f'./logs/{args["dataset"]}_sweep.log')
+
+    sweep_benchmark(args['dataset'], args['m'], args['p'], args['noise_p'], args['damping'], args['data_dir'],
+                    args['res_dir'], args['params_out'], args['processes'])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,11 @@ import os
 import random
 import logging
 import numpy as np
-import multiprocessing
-from sklearn.preprocessing import MinMaxScaler
+
+from .search import get_subseqs, nearest_pattern_search, pruned_pattern_search
+from .executor import PARALLEL_MIN_WORK, get_executor
+from .index import make_index
+from .scaler import StreamingScaler
 
 
 def seed_everything(seed=1234):
@@ -26,62 +29,34 @@ def init_logging(log_path):
     log.addHandler(consoleHandler)
 
 
-def scale_two_metrics(train_metrics, test_metrics):
-    est = MinMaxScaler()
-    scaled_train_metrics = est.fit_transform(train_metrics.reshape(-1, 1)).reshape(-1)
-    scaled_test_metrics = est.transform(test_metrics.reshape(-1, 1)).reshape(-1)
+def scale_two_metrics(train_metrics, test_metrics, dtype=None):
+    # With dtype=np.float32 the scaled metrics, and everything computed from them, are float32
+    est = StreamingScaler.from_metrics(train_metrics)
+    scaled_train_metrics = est.transform(np.asarray(train_metrics, dtype=dtype))
+    scaled_test_metrics = est.transform(np.asarray(test_metrics, dtype=dtype))
 
     return scaled_train_metrics, scaled_test_metrics
 
 
-def init_para(scaled_test_metrics, m, graph_centers, batch_size, batch_num, stride):
-    global scaled_test_metrics_global, m_global, graph_centers_global, batch_size_global, batch_num_global, stride_global
-    scaled_test_metrics_global, m_global, graph_centers_global, batch_size_global, batch_num_global, stride_global = \
-        scaled_test_metrics, m, graph_centers, batch_size, batch_num, stride
-
-
-def unit_operation(index_of_batch):
-    segs = get_batch_data(index_of_batch, m_global, batch_size_global,
-                          batch_num_global, stride_global, scaled_test_metrics_global)
-
-    dist_matrix = []
-    for graph_center in graph_centers_global:
-        dists = np.linalg.norm(segs - graph_center, axis=1)
-        dist_matrix.append(dists)
-
-    return [np.argmin(dist_matrix, axis=0).tolist(), np.min(dist_matrix, axis=0).tolist()]
-
-
-def get_batch_data(idx, m, batch_size, batch_num, stride, metrics):
-    batch_data = []
-
-    end_batch = (idx+1) * batch_size
-    if idx == batch_num - 1:
-        end_batch = len(metrics) - m + 1
-
-    for i in range(idx * batch_size, end_batch, stride):
-        batch_data.append(metrics[i: i+m])
-
-    return batch_data
-
-
-def find_nearest_pattern(scaled_test_metrics, m, graph_centers, stride=1):
-    batch_size = 10000
-    subseq_num = len(scaled_test_metrics) - m + 1
-    batch_num = int(subseq_num / batch_size) + 1
-
-    process_num = 8
-    pool = multiprocessing.Pool(process_num, initializer=init_para, initargs=(scaled_test_metrics, m, graph_centers,
-                                                                              batch_size, batch_num, stride))
+def find_nearest_pattern(scaled_test_metrics, m, graph_centers, stride=1, executor=None, index=None,
+                         index_params=None, pruning=False):
+    graph_centers = np.asarray(graph_centers)
+    if pruning:
+        # Lower bounds and early abandoning pay off for long subsequences, see pruned_pattern_search
+        return pruned_pattern_search(scaled_test_metrics, m, graph_centers, stride)
+    if index is not None:
+        # A large bank searched through an index (see adsketch.index) in the calling process
+        subseqs = get_subseqs(scaled_test_metrics, m, stride)
+        return make_index(graph_centers, index, **(index_params or {})).search(subseqs)
 
-    idx = np.arange(batch_num)
-    res_wrapper = pool.map(unit_operation, idx)
+    subseq_num = len(range(0, len(scaled_test_metrics) - m + 1, stride))
 
-    nearest_patterns, nearest_dists = [], []
-    for unit in res_wrapper:
-        nearest_patterns.extend(unit[0])
-        nearest_dists.extend(unit[1])
+    # Only fan out to the shared worker pool when the search outweighs the cost of sharing the inputs
+    if executor is None and subseq_num * len(graph_centers) * m >= PARALLEL_MIN_WORK:
+        executor = get_executor()
 
-    pool.close()
+    if executor is not None:
+        return executor.search(scaled_test_metrics, m, graph_centers, stride)
 
-    return nearest_patterns, nearest_dists
+    subseqs = get_subseqs(scaled_test_metrics, m, stride)
+    return nearest_pattern_search(subseqs, graph_centers)
@@ -35,7 +35,7 @@ def offline_aiops18_data():
     m, p = aiops18_params[metric_name]["m"], aiops18_params[metric_name]["p"]
     start, end = aiops18_params[metric_name]["seg"]  # Get the selected anomaly-free metric time series
     fig_dir = os.path.join(args['res_dir'], f'{metric_name}_{m}_{p}_offline.png')
-    offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}.pkl')
+    offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}{PATTERN_FILE_EXT}')
 
     train_metric_values, train_metric_labels, test_metric_values, test_metric_labels = load_aiops18_data(metric_name)
     # Select particular segments of data
@@ -72,7 +72,7 @@ def online_aiops18_data():
         logging.info(f'Adaptive pattern learning: {adaptive_learning}')
 
         fig_dir = os.path.join(args['res_dir'], f'{metric_name}_{m}_{p}_offline.png')
-        offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}.pkl')
+        offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}{PATTERN_FILE_EXT}')
 
         # Data preparation
         train_metric_values, train_metric_labels, test_metric_values, test_metric_labels = load_aiops18_data(metric_name)
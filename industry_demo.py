@@ -36,7 +36,7 @@ def offline_industry_data():
     metric_name = 'e59c1d14'
     m, p = industry_params[metric_name]["m"], industry_params[metric_name]["p"]
     fig_dir = os.path.join(args['res_dir'], f'{metric_name}_{m}_{p}_offline.png')
-    offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}.pkl')
+    offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}{PATTERN_FILE_EXT}')
 
     metric_values, metric_labels = load_industry_data(metric_name)
     # Select particular segments of data
@@ -68,7 +68,7 @@ def online_industry_data():
         logging.info(f'Adaptive pattern learning: {adaptive_learning}')
 
         fig_dir = os.path.join(args['res_dir'], f'{metric_name}_{m}_{p}_offline.png')
-        offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}.pkl')
+        offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}{PATTERN_FILE_EXT}')
 
         # Data preparation
         metric_values, metric_labels = load_industry_data(metric_name)
@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import argparse
+import warnings
+
+import pandas as pd
+
+from adsketch.motif_operations import *
+from adsketch.runner import DEFAULT_M, DEFAULT_P, DEFAULT_PARAMS, TRAIN_NUM, load_benchmark_data
+
+# Compare the float64 and float32 modes on the bundled benchmark datasets: the offline verdicts, the verdicts of
+# the nearest-pattern search over the test windows, the F1 and the memory of the scaled metrics and patterns
+DTYPES = {'float64': np.float64, 'float32': np.float32}
+
+
+def run_metric(m, p, discovery_params, metric_values, metric_labels, train_num, dtype):
+    scaled_train_metrics, scaled_test_metrics = scale_two_metrics(metric_values[:train_num],
+                                                                  metric_values[train_num:], dtype)
+    anomalous_subseqs, anomalous_clusters, _, cluster_centers, cluster_radii = anomaly_pattern_discovery(
+        scaled_train_metrics, scaled_test_metrics, m, p, **discovery_params)
+    cluster_centers = np.asarray(cluster_centers)
+
+    offline_verdicts = np.zeros(len(scaled_test_metrics) - m + 1, dtype=bool)
+    offline_verdicts[anomalous_subseqs] = True
+    start_time = time.time()
+    nearest_patterns, _ = find_nearest_pattern(scaled_test_metrics, m, cluster_centers)
+    search_time = time.time() - start_time
+    online_verdicts = np.isin(nearest_patterns, anomalous_clusters)
+
+    nbytes = scaled_train_metrics.nbytes + scaled_test_metrics.nbytes + cluster_centers.nbytes
+    f1 = evaluate(m, anomalous_subseqs, metric_labels[train_num:])[2]
+    return offline_verdicts, online_verdicts, f1, nbytes, search_time
+
+
+def benchmark_dataset(dataset, params, data_dir=None, train_num=TRAIN_NUM):
+    dataset_params = params.get(dataset, {})
+    default_m, default_p = DEFAULT_PARAMS.get(dataset, (DEFAULT_M, DEFAULT_P))
+    metric_values, metric_labels = load_benchmark_data(data_dir or f'data/{dataset}_benchmark')
+
+    rows = []
+    for metric_id in range(len(metric_values)):
+        metric_params = dataset_params.get(f'{dataset}_{metric_id + 1}', {})
+        m, p = metric_params.get('m', default_m), metric_params.get('p', default_p)
+        discovery_params = {key: metric_params[key] for key in ('noise_p', 'damping') if key in metric_params}
+        try:
+            results = {name: run_metric(m, p, discovery_params, metric_values[metric_id], metric_labels[metric_id],
+                                        train_num, dtype) for name, dtype in DTYPES.items()}
+        except Exception as e:
+            logging.warning(f'{dataset}_{metric_id + 1} failed: {e!r}')
+            continue
+
+        (offline64, online64, f1_64, nbytes64, time64), (offline32, online32, f1_32, nbytes32, time32) = \
+            results['float64'], results['float32']
+        rows.append({'dataset': dataset, 'windows': len(offline64),
+                     'offline_changed': np.count_nonzero(offline64 != offline32),
+                     'online_changed': np.count_nonzero(online64 != online32),
+                     'f1_float64': f1_64, 'f1_float32': f1_32, 'bytes_float64': nbytes64, 'bytes_float32': nbytes32,
+                     'search_s_float64': time64, 'search_s_float32': time32})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verdicts, F1 and memory of the float32 mode against float64')
+    parser.add_argument("--datasets", type=str, nargs='+', default=None,
+                        help="The benchmark names (default: every data/<dataset>_benchmark directory)")
+    parser.add_argument("--params", type=str, default='params.json', help="The tuned parameters of every metric")
+    parser.add_argument("--out", type=str, default='./res/precision_benchmark.csv',
+                        help="The CSV file of the per-metric comparison")
+    args = vars(parser.parse_args())
+
+    seed_everything(seed=1234)
+    logging.getLogger().setLevel(logging.WARNING)
+    warnings.filterwarnings('ignore')
+    datasets = args['datasets'] or sorted(name[:-len('_benchmark')] for name in os.listdir('data')
+                                          if name.endswith('_benchmark'))
+    with open(args['params'], 'r') as json_reader:
+        params = json.load(json_reader)
+
+    metric_df = pd.concat([benchmark_dataset(dataset, params) for dataset in datasets], ignore_index=True)
+    os.makedirs(os.path.dirname(args['out']) or '.', exist_ok=True)
+    metric_df.to_csv(args['out'], index=False)
+
+    summary = metric_df.groupby('dataset').agg(
+        metrics=('windows', 'size'), windows=('windows', 'sum'), offline_changed=('offline_changed', 'sum'),
+        online_changed=('online_changed', 'sum'), f1_float64=('f1_float64', 'mean'),
+        f1_float32=('f1_float32', 'mean'), bytes_float64=('bytes_float64', 'sum'),
+        bytes_float32=('bytes_float32', 'sum'), search_s_float64=('search_s_float64', 'sum'),
+        search_s_float32=('search_s_float32', 'sum'))
+    pd.set_option('display.width', 200)
+    print(summary.to_string(float_format='{:.3f}'.format))
+    print(f'\nPer-metric comparison saved to: {args["out"]}')
+
+
+if __name__ == '__main__':
+    main()
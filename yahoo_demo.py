@@ -45,7 +45,7 @@ def yahoo_offline():
         logging.info('=' * 60)
         logging.info(f'Dataset: yahoo (metric real_{metric_id}), m: {m}, p: {p}')
         fig_dir = os.path.join(args['res_dir'], f'real_{metric_id}_{m}_{p}.png')
-        offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}.pkl')
+        offline_pattern_dir = os.path.join(args['pattern_dir'], f'{metric_name}_{m}_{p}{PATTERN_FILE_EXT}')
 
         train_metric_values, test_metric_values = metric_values[metric_id][5:train_num], metric_values[metric_id][train_num:]
         test_metric_labels = metric_labels[metric_id][train_num:]